@@ -8,5 +8,6 @@ RESOURCES_DIR="$( cd "resources" && pwd )"
 
 mkdir -p vendor
 pip download --no-binary :all: -d vendor -r requirements.txt
+python3 template_registry.py templates/pcf_dashboard_template_v1.json templates/pcf_healthrules_template_v1.xml
 rm "${RESOURCES_DIR}/dashboard.zip"
-zip -r "${RESOURCES_DIR}/dashboard.zip" pcf_dash_generator.py service_config.py logging_config.ini requirements.txt runtime.txt vendor templates
\ No newline at end of file
+zip -r "${RESOURCES_DIR}/dashboard.zip" pcf_dash_generator.py controller_client.py template_registry.py instrumentation.py publish_jobs.py healthrule_reconciler.py metric_tree_cache.py dashboard_index.py refresh_scheduler.py service_config.py logging_config.ini requirements.txt runtime.txt vendor templates
\ No newline at end of file
@@ -0,0 +1,218 @@
+import os
+import re
+import zlib
+import time
+import binascii
+import logging
+import threading
+from instrumentation import metrics
+
+LOGIN_PATH = '/controller/auth?action=login'
+CSRF_TOKEN_NAME = 'X-CSRF-TOKEN'
+# the controller ui session normally times out after 60 minutes of inactivity; renew well before that
+LOGIN_MAX_AGE_SECONDS = 30 * 60
+CERT_FILE = 'cert.pem'
+GZIP_LEVEL = 6
+# app names are replaced in the endpoint label of the http metrics to keep their cardinality bounded
+ENDPOINT_APP_PATTERN = re.compile('/(applications|healthrules)/[^/?]+')
+
+logger = logging.getLogger()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_endpoint(path):
+    return ENDPOINT_APP_PATTERN.sub(r'/\1/{app}', path.split('?')[0])
+
+
+def get_body_size(body):
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+def get_tls_verify():
+    """the cert.pem written by service_config.write_cert_file() is used to verify the controller when ssl is enabled"""
+    if os.getenv('APPD_MA_SSL_ENABLED') == 'true' and os.path.exists(CERT_FILE):
+        return CERT_FILE
+    return True
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class MultipartFile(object):
+    """multipart/form-data request body with a single file field, streamed from the chunks of a generated file
+
+    get_chunks is a function returning a new iterable of the file's bytes chunks; it is called once to determine the
+    content length, which the controller requires, and again each time the body is sent, so the whole file is never
+    held in memory
+    """
+
+    def __init__(self, get_chunks, field_name='file', file_name=None, compress=False):
+        boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.get_chunks = get_chunks
+        self.compress = compress
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self.head = ('--' + boundary + '\r\nContent-Disposition: form-data; name="' + field_name + '"; filename="' +
+                     (file_name or field_name) + '"\r\n\r\n').encode('utf-8')
+        self.tail = ('\r\n--' + boundary + '--\r\n').encode('utf-8')
+        self._length = None
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum(len(chunk) for chunk in self)
+        return self._length
+
+    def __iter__(self):
+        if self.compress:
+            return iter_gzip(self._iter_parts())
+        return self._iter_parts()
+
+    def _iter_parts(self):
+        yield self.head
+        yield from self.get_chunks()
+        yield self.tail
+
+
+class ControllerClient(object):
+    """keep-alive connection pool to a single controller with a cached ui login session and csrf token"""
+
+    def __init__(self, controller_url, user_name, user_pass, timeout=None, pool_maxsize=10):
+        # requests is imported with the first client rather than with the module
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.controller_url = controller_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (user_name, user_pass)
+        self.session.verify = get_tls_verify()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._login_lock = threading.Lock()
+        self._login_time = None
+        # None until the first gzip encoded upload shows whether the controller accepts them
+        self.gzip_accepted = None
+
+    def url(self, path):
+        return self.controller_url + path
+
+    def request(self, method, path, **kwargs):
+        from requests import RequestException
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = get_endpoint(path)
+        start = time.time()
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+        except RequestException as e:
+            metrics.inc('pcf_dash_http_requests_total', help_text='controller requests by endpoint and status',
+                        method=method, endpoint=endpoint, status=type(e).__name__)
+            raise
+        metrics.observe('pcf_dash_http_request_duration_seconds', time.time() - start,
+                        help_text='controller request latency by endpoint', method=method, endpoint=endpoint)
+        metrics.inc('pcf_dash_http_requests_total', help_text='controller requests by endpoint and status',
+                    method=method, endpoint=endpoint, status=str(response.status_code))
+        metrics.inc('pcf_dash_http_request_bytes_total', get_body_size(response.request.body),
+                    help_text='bytes sent to the controller by endpoint', method=method, endpoint=endpoint)
+        metrics.inc('pcf_dash_http_response_bytes_total', int(response.headers.get('Content-Length', 0)),
+                    help_text='bytes received from the controller by endpoint', method=method, endpoint=endpoint)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def post_file(self, path, get_chunks, field_name='file', compress=False, **kwargs):
+        """uploads a file as multipart/form-data like post(path, files={field_name: ...}), streaming its chunks
+
+        with compress, the body is sent gzip encoded; if the first gzip encoded upload fails with any status, it is
+        repeated without compression, and later uploads are no longer compressed
+        """
+        if compress and self.gzip_accepted is not False:
+            response = self._post_multipart(path, MultipartFile(get_chunks, field_name, compress=True), kwargs)
+            if self.gzip_accepted or response.ok:
+                self.gzip_accepted = True
+                return response
+            # controllers and proxies reject an encoding they don't support with all kinds of statuses (400, 413, 415,
+            # 500), so any failure of the first one is taken to mean that gzip isn't accepted
+            logger.info('gzip encoded upload failed with status ' + str(response.status_code) +
+                        ', uploading uncompressed')
+            response.close()
+            self.gzip_accepted = False
+        return self._post_multipart(path, MultipartFile(get_chunks, field_name), kwargs)
+
+    def _post_multipart(self, path, body, kwargs):
+        headers = dict(kwargs.get('headers') or {})
+        headers['Content-Type'] = body.content_type
+        if body.compress:
+            headers['Content-Encoding'] = 'gzip'
+        return self.request('POST', path, data=body, headers=headers,
+                            **{name: value for name, value in kwargs.items() if name != 'headers'})
+
+    def _login_expired(self):
+        if self._login_time is None or CSRF_TOKEN_NAME not in self.session.headers:
+            return True
+        if CSRF_TOKEN_NAME not in self.session.cookies:
+            return True
+        return time.time() - self._login_time > LOGIN_MAX_AGE_SECONDS
+
+    def login(self, force=False):
+        with self._login_lock:
+            if not force and not self._login_expired():
+                return
+            logger.debug('logging in to controller: ' + self.controller_url)
+            self.session.headers.pop(CSRF_TOKEN_NAME, None)
+            response = self.get(LOGIN_PATH)
+            response.raise_for_status()
+            self.session.headers[CSRF_TOKEN_NAME] = response.cookies.get(CSRF_TOKEN_NAME) or \
+                self.session.cookies[CSRF_TOKEN_NAME]
+            self._login_time = time.time()
+
+    def ui_request(self, method, path, **kwargs):
+        """request against the controller restui, which requires a login session and csrf token"""
+        self.login()
+        response = self.request(method, path, **kwargs)
+        if response.status_code in (401, 403):
+            logger.debug('controller session rejected with status ' + str(response.status_code) + ', logging in again')
+            # releases the connection of a streamed response to the pool before it is used again
+            response.close()
+            self.login(force=True)
+            response = self.request(method, path, **kwargs)
+        return response
+
+    def ui_get(self, path, **kwargs):
+        return self.ui_request('GET', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_controller_client(controller_url, user_name, user_pass, timeout=None, pool_maxsize=10):
+    """returns the shared client for the given controller and user, creating it on first use"""
+    key = (controller_url, user_name)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None or client.session.auth != (user_name, user_pass):
+            client = ControllerClient(controller_url, user_name, user_pass, timeout, pool_maxsize)
+            _clients[key] = client
+        client.timeout = timeout
+        return client
+
+
+def reset_controller_clients():
+    """drops all pooled connections, e.g. after forking a new process"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
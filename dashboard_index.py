@@ -0,0 +1,116 @@
+import time
+import codecs
+import logging
+import threading
+from json import JSONDecoder
+
+LISTING_PATH = '/controller/restui/dashboards/getAllDashboardsByType/false'
+LISTING_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger()
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def iter_json_array(chunks):
+    """yields the elements of a json array as they are decoded from the bytes chunks, without holding the whole
+    document in memory"""
+    decoder = JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('expected a json array')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the element continues in the next chunk
+                break
+            yield element
+    raise ValueError('unterminated json array')
+
+
+class DashboardIndex(object):
+    """name to id map of the dashboards on a controller, refreshed from the dashboard listing when it is older than the
+    ttl, with a conditional request if the controller sent an etag
+
+    dashboards uploaded by this process are added locally, so they are found without another listing
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.dashboards = {}
+        self.etag = None
+        self.refreshed = None
+        self._lock = threading.Lock()
+
+    def _expired(self):
+        return self.refreshed is None or time.time() - self.refreshed >= self.ttl
+
+    def refresh(self, client):
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        response = client.ui_get(LISTING_PATH, headers=headers, stream=True)
+        try:
+            if response.status_code == 304:
+                logger.debug('dashboard listing not modified')
+            else:
+                response.raise_for_status()
+                dashboards = {}
+                for dashboard in iter_json_array(response.iter_content(LISTING_CHUNK_SIZE)):
+                    dashboards.setdefault(dashboard['name'], dashboard.get('id'))
+                logger.debug('indexed ' + str(len(dashboards)) + ' dashboards')
+                self.dashboards = dashboards
+                self.etag = response.headers.get('ETag')
+        finally:
+            response.close()
+        self.refreshed = time.time()
+
+    def get_id(self, client, name, refresh=False):
+        """returns the id of the named dashboard (None if the id isn't known), or False if there is no such dashboard"""
+        with self._lock:
+            if refresh or self._expired():
+                self.refresh(client)
+            return self.dashboards.get(name, False)
+
+    def exists(self, client, name, refresh=False):
+        return self.get_id(client, name, refresh) is not False
+
+    def add(self, name, dashboard_id=None):
+        """records a dashboard uploaded by this process; the etag is dropped, as the listing it belongs to is stale"""
+        with self._lock:
+            self.dashboards[name] = dashboard_id
+            self.etag = None
+
+    def clear(self):
+        with self._lock:
+            self.dashboards = {}
+            self.etag = None
+            self.refreshed = None
+
+
+def get_dashboard_index(controller_url, user_name, ttl):
+    """returns the shared index of the dashboards the given user sees on the controller, creating it on first use"""
+    key = (controller_url, user_name)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = DashboardIndex(ttl)
+            _indexes[key] = index
+        index.ttl = ttl
+        return index
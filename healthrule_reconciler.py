@@ -0,0 +1,91 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+logger = logging.getLogger()
+
+
+class HealthRuleDiff(object):
+
+    def __init__(self, added, changed, unchanged, removed):
+        self.added = added
+        self.changed = changed
+        self.unchanged = unchanged
+        self.removed = removed
+
+    def __str__(self):
+        return 'added=' + str(len(self.added)) + ', changed=' + str(len(self.changed)) +\
+               ', unchanged=' + str(len(self.unchanged)) + ', not generated=' + str(len(self.removed))
+
+
+def iter_healthrules(healthrules_xml):
+    """yields (root, name, element) for each <health-rule> as soon as it is parsed, and drops it from the tree once the
+    caller is done with it, so that only one health rule is held in memory at a time
+
+    healthrules_xml is the xml document, or an iterable of its chunks as rendered by the template registry or read from
+    a streamed response
+    """
+    if isinstance(healthrules_xml, (bytes, str)):
+        healthrules_xml = (healthrules_xml,)
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in healthrules_xml:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            elif event == 'end' and element.tag == 'health-rule' and element in root:
+                yield root, element.findtext('name'), element
+                root.remove(element)
+    parser.close()
+
+
+def normalize_healthrule(element):
+    """comparable form of an element that ignores formatting whitespace, attribute order and empty vs self-closing tags"""
+    return (element.tag,
+            tuple(sorted(element.attrib.items())),
+            (element.text or '').strip(),
+            tuple(normalize_healthrule(child) for child in element))
+
+
+def get_healthrule_digests(healthrules_xml):
+    """returns an ordered dict of health rule name to the digest of its normalized form, see normalize_healthrule()"""
+    digests = OrderedDict()
+    for root, name, healthrule in iter_healthrules(healthrules_xml):
+        digests[name] = hashlib.sha1(repr(normalize_healthrule(healthrule)).encode('utf-8')).hexdigest()
+    return digests
+
+
+def diff_healthrules(generated, current):
+    """generated and current map health rule names to their digests, see get_healthrule_digests()"""
+    added = []
+    changed = []
+    unchanged = []
+    for name, digest in generated.items():
+        if name not in current:
+            added.append(name)
+        elif digest != current[name]:
+            changed.append(name)
+        else:
+            unchanged.append(name)
+    removed = [name for name in current if name not in generated]
+    return HealthRuleDiff(added, changed, unchanged, removed)
+
+
+def iter_healthrules_xml(healthrules_xml, names):
+    """streams the named health rules out of the health rules xml (or its chunks) in a copy of its <health-rules> root,
+    yielding one utf-8 chunk per health rule"""
+    names = set(names)
+    started = False
+    for root, name, healthrule in iter_healthrules(healthrules_xml):
+        if name not in names:
+            continue
+        if not started:
+            attributes = ''.join(' ' + key + '=' + quoteattr(value) for key, value in root.attrib.items())
+            yield ('<' + root.tag + attributes + '>').encode('utf-8')
+            started = True
+        yield ElementTree.tostring(healthrule, encoding='UTF-8')
+    if started:
+        yield ('</' + root.tag + '>').encode('utf-8')
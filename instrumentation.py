@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+logger = logging.getLogger()
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + escape_label_value(value) + '"' for name, value in labels) + '}'
+
+
+class Metrics(object):
+    """thread safe registry of counters, gauges and summaries (count/sum/max), rendered in the prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._values = {}
+
+    def _key(self, metric_type, name, help_text, labels):
+        self._types.setdefault(name, metric_type)
+        if help_text:
+            self._help.setdefault(name, help_text)
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, help_text=None, **labels):
+        with self._lock:
+            key = self._key(COUNTER, name, help_text, labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, help_text=None, **labels):
+        with self._lock:
+            self._values[self._key(GAUGE, name, help_text, labels)] = value
+
+    def observe(self, name, value, help_text=None, **labels):
+        with self._lock:
+            key = self._key(SUMMARY, name, help_text, labels)
+            count, total, maximum = self._values.get(key, (0, 0.0, value))
+            self._values[key] = (count + 1, total + value, max(maximum, value))
+
+    @contextmanager
+    def timed(self, name, help_text=None, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, help_text, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'types': dict(self._types),
+                'help': dict(self._help),
+                'values': [[name, [list(label) for label in labels], value]
+                           for (name, labels), value in self._values.items()]
+            }
+
+    def clear(self):
+        with self._lock:
+            self._types.clear()
+            self._help.clear()
+            self._values.clear()
+
+
+def to_prometheus(snapshots):
+    """renders a list of (extra labels, snapshot) in the prometheus text exposition format"""
+    types = {}
+    help_texts = {}
+    samples = {}
+    for extra_labels, snapshot in snapshots:
+        types.update(snapshot['types'])
+        help_texts.update(snapshot['help'])
+        for name, labels, value in snapshot['values']:
+            labels = list(extra_labels) + [tuple(label) for label in labels]
+            samples.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(samples):
+        metric_type = types.get(name, GAUGE)
+        if name in help_texts:
+            lines.append('# HELP ' + name + ' ' + help_texts[name])
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+        for labels, value in samples[name]:
+            if metric_type == SUMMARY:
+                count, total, maximum = value
+                lines.append(name + '_count' + format_labels(labels) + ' ' + repr(float(count)))
+                lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(float(total)))
+            else:
+                lines.append(name + format_labels(labels) + ' ' + repr(float(value)))
+        if metric_type == SUMMARY:
+            lines.append('# TYPE ' + name + '_max gauge')
+            for labels, value in samples[name]:
+                lines.append(name + '_max' + format_labels(labels) + ' ' + repr(float(value[2])))
+    return '\n'.join(lines) + '\n'
+
+
+def get_snapshot_file(metrics_dir, role, pid):
+    return os.path.join(metrics_dir, role + '-' + str(pid) + '.json')
+
+
+def dump_metrics(metrics, metrics_dir, role):
+    """writes this process's metrics where the service's /metrics endpoint can aggregate them"""
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        snapshot_file = get_snapshot_file(metrics_dir, role, os.getpid())
+        with open(snapshot_file + '.tmp', 'w', encoding='utf-8') as myfile:
+            json.dump(metrics.snapshot(), myfile)
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+    except OSError as e:
+        logger.warning('unable to write metrics snapshot: ' + str(e))
+
+
+def pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect_metrics(metrics, metrics_dir, role):
+    """returns the live metrics of this process plus the snapshots dumped by other live processes"""
+    snapshots = [((('process', role), ('pid', str(os.getpid()))), metrics.snapshot())]
+    if not os.path.isdir(metrics_dir):
+        return snapshots
+    for file_name in sorted(os.listdir(metrics_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        snapshot_role, _, pid = file_name[:-len('.json')].rpartition('-')
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        snapshot_file = os.path.join(metrics_dir, file_name)
+        if not pid_is_alive(int(pid)):
+            try:
+                os.remove(snapshot_file)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(snapshot_file, 'r', encoding='utf-8') as myfile:
+                snapshots.append(((('process', snapshot_role), ('pid', pid)), json.load(myfile)))
+        except (OSError, ValueError) as e:
+            logger.debug('unable to read metrics snapshot ' + snapshot_file + ': ' + str(e))
+    return snapshots
+
+
+metrics = Metrics()
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import fcntl
+import random
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+# each listing's ttl is spread by up to this fraction, so that the listings of a tree aren't all revalidated at once
+TTL_JITTER = 0.1
+SCOPE_FILE_SUFFIX = '.json'
+
+logger = logging.getLogger()
+
+
+def get_folder_names(folders):
+    return sorted(str(folder['name']) for folder in folders)
+
+
+class CachedScope(object):
+    """the listings of one scope, as last read from or written to its file in the cache dir"""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock_file = cache_file + '.lock'
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.file_id = None
+
+
+class MetricTreeCache(object):
+    """metric browser listings cached on disk by scope (controller and app) and metric path, shared by every process
+    using the same cache dir
+
+    each scope is kept in a file of its own, so that targets on different controllers or apps don't contend for the
+    same file, and the listings of a discovery step are written together with put_many()
+
+    each listing expires after its own ttl and is then listed again; if the new listing differs, the cached listings
+    below it are expired as well (and dropped below folders that are gone), so only the subtrees under a changed
+    listing are walked again
+    """
+
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._scopes = {}
+
+    def _get_scope(self, scope):
+        with self._lock:
+            cached = self._scopes.get(scope)
+            if cached is None:
+                file_name = hashlib.sha1(scope.encode('utf-8')).hexdigest() + SCOPE_FILE_SUFFIX
+                cached = CachedScope(os.path.join(self.cache_dir, file_name))
+                self._scopes[scope] = cached
+            return cached
+
+    @contextmanager
+    def _file_lock(self, cached, exclusive):
+        with open(cached.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self, cached):
+        """re-reads the scope's file if another process replaced it since it was last read; called with its locks"""
+        try:
+            stat = os.stat(cached.cache_file)
+        except FileNotFoundError:
+            cached.entries, cached.file_id = {}, None
+            return
+        file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_id == cached.file_id:
+            return
+        try:
+            with open(cached.cache_file, 'r', encoding='utf-8') as myfile:
+                cached.entries = json.loads(myfile.read())['listings']
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('ignoring unreadable metric cache ' + cached.cache_file + ': ' + str(e))
+            cached.entries = {}
+        cached.file_id = file_id
+
+    def _save(self, scope, cached):
+        data = json.dumps({'scope': scope, 'listings': cached.entries}, separators=(',', ':'))
+        with open(cached.cache_file + '.tmp', 'w', encoding='utf-8') as myfile:
+            myfile.write(data)
+        os.replace(cached.cache_file + '.tmp', cached.cache_file)
+        stat = os.stat(cached.cache_file)
+        cached.file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def get(self, scope, metric_path):
+        """returns the cached listing of the metric path, or None if it isn't cached or has expired"""
+        cached = self._get_scope(scope)
+        if not os.path.exists(cached.cache_file):
+            return None
+        with cached.lock, self._file_lock(cached, False):
+            self._load(cached)
+            entry = cached.entries.get(metric_path)
+        if entry is None or entry['expires'] <= time.time():
+            return None
+        return entry['folders']
+
+    def put(self, scope, metric_path, folders):
+        """caches a fresh listing of the metric path; returns True if it differs from the previous listing"""
+        return metric_path in self.put_many(scope, {metric_path: folders})
+
+    def put_many(self, scope, listings):
+        """caches fresh listings, a dict of metric path to folders, with a single write of the scope's file; returns
+        the metric paths whose listing differs from the previous one"""
+        if not listings:
+            return []
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cached = self._get_scope(scope)
+        changed = []
+        with cached.lock, self._file_lock(cached, True):
+            self._load(cached)
+            # parents first, so that a changed parent doesn't expire a child listed along with it
+            for metric_path in sorted(listings, key=lambda metric_path: metric_path.count('|')):
+                if self._update(cached.entries, metric_path, listings[metric_path]):
+                    changed.append(metric_path)
+            self._save(scope, cached)
+        return changed
+
+    def _update(self, entries, metric_path, folders):
+        previous = entries.get(metric_path)
+        changed = previous is not None and get_folder_names(previous['folders']) != get_folder_names(folders)
+        if changed:
+            logger.debug('metric path listing changed, revalidating its subtrees: ' + metric_path)
+            names = set(get_folder_names(folders))
+            prefix = metric_path + '|'
+            for path in [path for path in entries if path.startswith(prefix)]:
+                if path[len(prefix):].split('|')[0] in names:
+                    entries[path]['expires'] = 0
+                else:
+                    del entries[path]
+        entries[metric_path] = {
+            'folders': folders,
+            'expires': time.time() + self.ttl * (1 + random.uniform(-TTL_JITTER, TTL_JITTER))
+        }
+        return changed
+
+    def clear(self, scope):
+        """drops all cached listings of the scope"""
+        cached = self._get_scope(scope)
+        if not os.path.exists(cached.cache_file):
+            return
+        with cached.lock, self._file_lock(cached, True):
+            try:
+                os.remove(cached.cache_file)
+            except FileNotFoundError:
+                pass
+            cached.entries, cached.file_id = {}, None
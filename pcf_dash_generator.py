@@ -1,16 +1,28 @@
 #!flask/bin/python
-from flask import Flask, request, Response
+# flask, requests and tenacity are imported where they are first used, so that importing this module stays cheap and
+# free of side effects; the service is built by create_app() and the background refresh is run by run_publisher()
+from contextlib import contextmanager
+from functools import partial
 from string import Template
 import os
 import argparse
-import requests
 import re
 import logging
-from logging.config import fileConfig
-from requests.exceptions import HTTPError
-from tenacity import *
 import time
+import json
+import threading
+import hashlib
 from json.decoder import JSONDecodeError
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from controller_client import get_controller_client
+from metric_tree_cache import MetricTreeCache
+from dashboard_index import get_dashboard_index
+from template_registry import template_registry
+from publish_jobs import PublishJobManager, PublishJob, JOB_SUCCEEDED, JOB_FAILED, run_job, save_job_status
+from instrumentation import metrics, dump_metrics, collect_metrics, to_prometheus
+from refresh_scheduler import RefreshScheduler
+from healthrule_reconciler import iter_healthrules, get_healthrule_digests, diff_healthrules, iter_healthrules_xml
 
 pcf_dash_template_file = 'templates/pcf_dashboard_template_v1.json'
 pcf_dash_generated_file = 'generated/pcf_dashboard_generated.json'
@@ -22,14 +34,39 @@ pcf_hrs_generated_file = 'generated/pcf_healthrules_generated.xml'
 DASHBOARD_NAME = '${APPLICATION_NAME}-${TIER_NAME}-PCF KPI Dashboard'
 PUBLISH_MAX_RETRIES = 10
 PUBLISH_MAX_RETRY_DELAY_SECONDS = 60
+# upper bound on how long to wait for uploaded health rules to be saved before uploading the dashboard
 DELAY_AFTER_HR_UPLOAD_SECONDS = 30
+HR_READY_INITIAL_POLL_SECONDS = 0.5
+HR_READY_LOG_FILE = 'hr_readiness.log'
+HEALTHRULES_EXPORT_CHUNK_SIZE = 64 * 1024
+DISCOVERY_MAX_WORKERS = 8
+REQUEST_TIMEOUT_SECONDS = 30
+STATE_DIR = 'state'
+PUBLISH_JOB_MAX_WORKERS = 1
+TARGET_MAX_CONCURRENCY = 4
+# the background refresh of each target is spread by up to this fraction of its interval, and the first refresh after
+# startup by up to REFRESH_SPLAY_SECONDS, so that generators restarted together don't all hit the controller at once
+REFRESH_JITTER = 0.1
+REFRESH_SPLAY_SECONDS = 30
+REFRESH_MAX_BACKOFF_SECONDS = 1800
+REFRESH_DEADLINE_SECONDS = 900
+# discovery snapshots record what discovery found for a target, so that it can be rendered without the controller
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = '.snapshot.json'
+# metric browser listings are cached in the state dir for this long; 0 disables the cache
+METRIC_CACHE_TTL_SECONDS = 900
+METRIC_CACHE_DIR = 'metric_cache'
+# the name to id map of each controller's dashboards is listed again when older than this; 0 lists it on every check
+DASHBOARD_INDEX_TTL_SECONDS = 900
+SYSTEM_METRICS_ROOT_PATH = 'Application Infrastructure Performance|${TIER_NAME}' +\
+                           '|Custom Metrics|PCF Firehose Monitor|System (BOSH) Metrics|bosh-system-metrics-forwarder'
 PCF_SERVICE_NAMES = ['clock_global', 'cloud_controller', 'cloud_controller_worker', 'consul_server', 'credhub', 
                      'diego_brain', 'diego_cell', 'diego_database', 'doppler', 'loggregator_trafficcontroller', 
                      'mysql', 'mysql_proxy', 'nats', 'router', 'syslog_adapter', 'syslog_scheduler', 'tcp_router', 'uaa'] 
 
-fileConfig('logging_config.ini')
+LOGGING_CONFIG_FILE = 'logging_config.ini'
+
 logger = logging.getLogger()
-service = Flask(__name__)
 
 
 class MetricPathNotFound(Exception):
@@ -37,23 +74,111 @@ class MetricPathNotFound(Exception):
         super().__init__(message)
 
 
+class TargetConfig(object):
+    """the controller, app and tier a dashboard and set of health rules are published to"""
+
+    def __init__(self, controller_url, account_name, user_name, user_pass, app, tier, tier_id,
+                 recreate_dashboard=False, overwrite_hrs=False, name=None, refresh_interval=None):
+        self.controller_url = controller_url
+        self.account_name = account_name
+        self.user_name = user_name
+        self.user_pass = user_pass
+        self.app = app
+        self.tier = tier
+        self.tier_id = tier_id
+        self.recreate_dashboard = recreate_dashboard
+        self.overwrite_hrs = overwrite_hrs
+        self.name = name or str(app) + '-' + str(tier)
+        # seconds between background refreshes, None for the service's default
+        self.refresh_interval = refresh_interval
+
+    def __repr__(self):
+        return 'TargetConfig(' + self.name + ')'
+
+    def get_full_user_name(self):
+        return self.user_name + '@' + self.account_name
+
+    def get_dashboard_index(self):
+        return get_dashboard_index(self.controller_url, self.get_full_user_name(), AppConfig.dashboard_index_ttl)
+
+    def get_client(self):
+        return get_controller_client(self.controller_url, self.get_full_user_name(), self.user_pass,
+                                     timeout=AppConfig.request_timeout,
+                                     pool_maxsize=max(10, AppConfig.discovery_max_workers))
+
+    def with_overrides(self, overrides):
+        """returns a copy of this target with the given target list entry applied"""
+        settings = dict(self.__dict__)
+        if 'controller_host' in overrides:
+            settings['controller_url'] = AppConfig.get_controller_url(overrides['controller_host'],
+                                                                      overrides.get('controller_port'),
+                                                                      overrides.get('controller_ssl_enabled'))
+        for key in ('controller_url', 'account_name', 'user_name', 'user_pass', 'app', 'tier', 'tier_id',
+                    'recreate_dashboard', 'overwrite_hrs', 'name', 'refresh_interval'):
+            if key in overrides:
+                settings[key] = overrides[key]
+        if 'name' not in overrides:
+            settings['name'] = None
+        return TargetConfig(**settings)
+
+
 class AppConfig(object):
-    controller_url = None
-    account_name = None
-    user_name = None
-    user_pass = None
-    app = None
-    tier = None
-    tier_id = None
-    recreate_dashboard = False    
-    overwrite_hrs = False
+    targets = []
+    target_max_concurrency = TARGET_MAX_CONCURRENCY
+    discovery_max_workers = DISCOVERY_MAX_WORKERS
+    request_timeout = REQUEST_TIMEOUT_SECONDS
+    state_dir = STATE_DIR
+    hr_ready_max_wait = DELAY_AFTER_HR_UPLOAD_SECONDS
+    gzip_uploads = False
+    snapshot_dir = None
+    snapshot_only = False
+    metric_cache_ttl = METRIC_CACHE_TTL_SECONDS
+    dashboard_index_ttl = DASHBOARD_INDEX_TTL_SECONDS
+    force = False
+    publish_job_max_workers = PUBLISH_JOB_MAX_WORKERS
+    refresh_jitter = REFRESH_JITTER
+    refresh_splay = REFRESH_SPLAY_SECONDS
+    refresh_max_backoff = REFRESH_MAX_BACKOFF_SECONDS
+    refresh_deadline = REFRESH_DEADLINE_SECONDS
+    # set once the configuration has been read from the environment or the command line
+    configured = False
+    # 'web' for the gunicorn workers, 'publisher' for the background refresh process
+    process_role = 'web'
     start_service = None
     port = None
     commandline = False
 
     @classmethod
-    def get_full_user_name(cls):
-        return cls.user_name + '@' + cls.account_name
+    def get_target(cls, name=None):
+        """returns the target with the given name, or the only target if name is None"""
+        if name is None:
+            if len(cls.targets) != 1:
+                raise KeyError('target name is required when ' + str(len(cls.targets)) + ' targets are configured')
+            return cls.targets[0]
+        for target in cls.targets:
+            if target.name == name:
+                return target
+        raise KeyError('unknown target: ' + name)
+
+    @staticmethod
+    def load_targets(default_target, targets_file=None, targets_json=None):
+        """the target list is a json list of objects; each object overrides settings of the default target"""
+        if targets_file:
+            with open(targets_file, 'r', encoding='utf-8') as myfile:
+                target_list = json.load(myfile)
+        elif targets_json:
+            target_list = json.loads(targets_json)
+        else:
+            return [default_target]
+        targets = [default_target.with_overrides(overrides) for overrides in target_list]
+        names = [target.name for target in targets]
+        if len(set(names)) != len(names):
+            raise ValueError('target names must be unique: ' + str(names))
+        return targets
+
+    @classmethod
+    def get_metrics_dir(cls):
+        return os.path.join(cls.state_dir, 'metrics')
 
     @staticmethod
     def get_controller_url(host, port, ssl_enabled):
@@ -63,7 +188,8 @@ class AppConfig(object):
             controller_url = 'http://'
         controller_url += host
         if port:
-            controller_url += ':' + port
+            # a port from a json target list may be a number
+            controller_url += ':' + str(port)
         return controller_url
 
 
@@ -71,17 +197,34 @@ def parse_env():
     controller_host = os.getenv('APPD_MA_HOST_NAME')
     controller_port = os.getenv('APPD_MA_PORT')
     controller_ssl_enabled = os.getenv('APPD_MA_SSL_ENABLED')
-    AppConfig.controller_url = AppConfig.get_controller_url(controller_host, controller_port, controller_ssl_enabled)
-    logger.debug('controller url: ' + AppConfig.controller_url)
-    AppConfig.account_name = os.getenv('APPD_MA_ACCOUNT_NAME', 'customer1')
-    AppConfig.user_name = os.getenv('APPD_MA_USER_NAME')
-    AppConfig.user_pass = os.getenv('APPD_MA_USER_PASS')
-    AppConfig.app = os.getenv('APPD_NOZZLE_APP_NAME')
-    AppConfig.tier = os.getenv('APPD_NOZZLE_TIER_NAME')
-    AppConfig.tier_id = os.getenv('APPD_NOZZLE_TIER_ID')
-    AppConfig.recreate_dashboard = os.getenv('APPD_MA_RECREATE_DASHBOARD')
-    AppConfig.overwrite_hrs = os.getenv('APPD_MA_OVERWRITE_HRS')
-    
+    controller_url = AppConfig.get_controller_url(controller_host, controller_port, controller_ssl_enabled)
+    logger.debug('controller url: ' + controller_url)
+    default_target = TargetConfig(controller_url,
+                                  os.getenv('APPD_MA_ACCOUNT_NAME', 'customer1'),
+                                  os.getenv('APPD_MA_USER_NAME'),
+                                  os.getenv('APPD_MA_USER_PASS'),
+                                  os.getenv('APPD_NOZZLE_APP_NAME'),
+                                  os.getenv('APPD_NOZZLE_TIER_NAME'),
+                                  os.getenv('APPD_NOZZLE_TIER_ID'),
+                                  os.getenv('APPD_MA_RECREATE_DASHBOARD'),
+                                  os.getenv('APPD_MA_OVERWRITE_HRS'))
+    AppConfig.targets = AppConfig.load_targets(default_target, os.getenv('APPD_MA_TARGETS_FILE'),
+                                               os.getenv('APPD_MA_TARGETS'))
+    logger.debug('targets: ' + str(AppConfig.targets))
+    AppConfig.target_max_concurrency = int(os.getenv('APPD_MA_TARGET_MAX_CONCURRENCY', TARGET_MAX_CONCURRENCY))
+    AppConfig.discovery_max_workers = int(os.getenv('APPD_MA_DISCOVERY_MAX_WORKERS', DISCOVERY_MAX_WORKERS))
+    AppConfig.request_timeout = float(os.getenv('APPD_MA_REQUEST_TIMEOUT_SECONDS', REQUEST_TIMEOUT_SECONDS))
+    AppConfig.state_dir = os.getenv('APPD_MA_STATE_DIR', STATE_DIR)
+    AppConfig.hr_ready_max_wait = float(os.getenv('APPD_MA_HR_READY_MAX_WAIT_SECONDS', DELAY_AFTER_HR_UPLOAD_SECONDS))
+    AppConfig.publish_job_max_workers = int(os.getenv('APPD_MA_PUBLISH_JOB_MAX_WORKERS', PUBLISH_JOB_MAX_WORKERS))
+    AppConfig.refresh_jitter = float(os.getenv('APPD_MA_REFRESH_JITTER', REFRESH_JITTER))
+    AppConfig.refresh_splay = float(os.getenv('APPD_MA_REFRESH_SPLAY_SECONDS', REFRESH_SPLAY_SECONDS))
+    AppConfig.refresh_max_backoff = float(os.getenv('APPD_MA_REFRESH_MAX_BACKOFF_SECONDS', REFRESH_MAX_BACKOFF_SECONDS))
+    AppConfig.refresh_deadline = float(os.getenv('APPD_MA_REFRESH_DEADLINE_SECONDS', REFRESH_DEADLINE_SECONDS))
+    AppConfig.gzip_uploads = os.getenv('APPD_MA_GZIP_UPLOADS') == 'true'
+    AppConfig.snapshot_dir = os.getenv('APPD_MA_SNAPSHOT_DIR')
+    AppConfig.metric_cache_ttl = float(os.getenv('APPD_MA_METRIC_CACHE_TTL_SECONDS', METRIC_CACHE_TTL_SECONDS))
+    AppConfig.dashboard_index_ttl = float(os.getenv('APPD_MA_DASHBOARD_INDEX_TTL_SECONDS', DASHBOARD_INDEX_TTL_SECONDS))
 
 
 def parse_args():
@@ -103,87 +246,181 @@ def parse_args():
                         action='store_true', default=False)
     parser.add_argument("--overwrite_hrs", help='set to true to overwrite existing health rules on the target controller',
                         action='store_true', default=False)
+    parser.add_argument('--discovery_max_workers', help='max number of concurrent metric browser requests during discovery',
+                        type=int, default=DISCOVERY_MAX_WORKERS)
+    parser.add_argument('--request_timeout', help='timeout in seconds for each controller request',
+                        type=float, default=REQUEST_TIMEOUT_SECONDS)
+    parser.add_argument('--state_dir', help='directory where the fingerprint of the last publish is kept',
+                        default=STATE_DIR)
+    parser.add_argument('--hr_ready_max_wait', help='max seconds to wait for uploaded health rules to be saved',
+                        type=float, default=DELAY_AFTER_HR_UPLOAD_SECONDS)
+    parser.add_argument('--targets_file', help='json file with a list of targets (app, tier, tier_id and optionally '
+                                               'controller settings) that override the target given by the other options',
+                        default=None)
+    parser.add_argument('--target_max_concurrency', help='max number of targets published concurrently',
+                        type=int, default=TARGET_MAX_CONCURRENCY)
+    parser.add_argument('--gzip_uploads', help='gzip the dashboard and health rule uploads if the controller accepts it',
+                        action='store_true', default=False)
+    parser.add_argument('--metric_cache_ttl', help='seconds metric browser listings are cached in the state dir, 0 '
+                                                   'disables the cache', type=float, default=METRIC_CACHE_TTL_SECONDS)
+    parser.add_argument('--dashboard_index_ttl', help='seconds the dashboard names listed by the controller are cached, '
+                                                      '0 lists them on every check', type=float,
+                        default=DASHBOARD_INDEX_TTL_SECONDS)
+    parser.add_argument('--snapshot_dir', help='directory where a discovery snapshot of each target is recorded, see '
+                                               'utils/render_snapshots.py', default=None)
+    parser.add_argument('--snapshot_only', help='only discover the targets and record their snapshots in --snapshot_dir, '
+                                                'without generating or uploading anything', action='store_true',
+                        default=False)
+    parser.add_argument("--force", help='publish even if the foundation and templates are unchanged since the last publish',
+                        action='store_true', default=False)
     args = parser.parse_args()
     logger.info('args: ' + str(args))
-    AppConfig.controller_url = AppConfig.get_controller_url(args.controller_host, args.controller_port,
-                                                            args.controller_ssl_enabled)
-    logger.debug('controller url: ' + AppConfig.controller_url)
-    AppConfig.account_name = args.account_name
-    AppConfig.user_name = args.user_name
-    AppConfig.user_pass = args.user_pass
-    AppConfig.app = args.app
-    AppConfig.tier = args.tier
-    AppConfig.tier_id = args.tier_id
-    AppConfig.recreate_dashboard = args.recreate_dashboard
-    AppConfig.overwrite_hrs = args.overwrite_hrs    
+    if args.snapshot_only and not args.snapshot_dir:
+        parser.error('--snapshot_only requires --snapshot_dir')
+    controller_url = AppConfig.get_controller_url(args.controller_host, args.controller_port,
+                                                  args.controller_ssl_enabled)
+    logger.debug('controller url: ' + controller_url)
+    default_target = TargetConfig(controller_url, args.account_name, args.user_name, args.user_pass,
+                                  args.app, args.tier, args.tier_id, args.recreate_dashboard, args.overwrite_hrs)
+    AppConfig.targets = AppConfig.load_targets(default_target, args.targets_file)
+    AppConfig.target_max_concurrency = args.target_max_concurrency
+    AppConfig.discovery_max_workers = args.discovery_max_workers
+    AppConfig.request_timeout = args.request_timeout
+    AppConfig.state_dir = args.state_dir
+    AppConfig.hr_ready_max_wait = args.hr_ready_max_wait
+    AppConfig.gzip_uploads = args.gzip_uploads
+    AppConfig.snapshot_dir = args.snapshot_dir
+    AppConfig.metric_cache_ttl = args.metric_cache_ttl
+    AppConfig.dashboard_index_ttl = args.dashboard_index_ttl
+    AppConfig.snapshot_only = args.snapshot_only
+    AppConfig.force = args.force
     AppConfig.start_service = args.start_service
     AppConfig.service_port = args.service_port
 
 
-def get_system_metrics_parent_folder():
-    metric_path_root = 'Application Infrastructure Performance|' + AppConfig.tier +\
-                       '|Custom Metrics|PCF Firehose Monitor|System (BOSH) Metrics|bosh-system-metrics-forwarder'
-    query_prams='?output=json&metric-path=' + metric_path_root
-    url = AppConfig.controller_url + '/controller/rest/applications/' + AppConfig.app + '/metrics' + query_prams
-    logger.debug('url: ' + url)
-    response = requests.get(url, auth=(AppConfig.get_full_user_name(), AppConfig.user_pass))
+def get_system_metrics_root_path(target):
+    return Template(SYSTEM_METRICS_ROOT_PATH).substitute(TIER_NAME=target.tier)
+
+
+_metric_cache = None
+_metric_cache_lock = threading.Lock()
+
+
+def get_metric_cache():
+    """returns the metric browser cache shared through the state dir, or None if it is disabled"""
+    global _metric_cache
+    if AppConfig.metric_cache_ttl <= 0:
+        return None
+    cache_dir = os.path.join(AppConfig.state_dir, METRIC_CACHE_DIR)
+    with _metric_cache_lock:
+        if _metric_cache is None or _metric_cache.cache_dir != cache_dir or \
+                _metric_cache.ttl != AppConfig.metric_cache_ttl:
+            _metric_cache = MetricTreeCache(cache_dir, AppConfig.metric_cache_ttl)
+        return _metric_cache
+
+
+def get_metric_cache_scope(target):
+    return target.controller_url + '|' + target.app
+
+
+def get_cached_metric_folders(cache, target, metric_path, refresh):
+    """returns the cached listing of the metric path, or None if it has to be listed"""
+    if cache is None or refresh:
+        return None
+    folders = cache.get(get_metric_cache_scope(target), metric_path)
+    if folders is not None:
+        metrics.inc('pcf_dash_metric_cache_total', help_text='metric browser listings served from the cache (hit) '
+                    'or the controller (miss)', result='hit')
+    return folders
+
+
+def list_metric_folders(target, metric_path):
+    path = '/controller/rest/applications/' + target.app + '/metrics'
+    query_prams = {
+        'output': 'json',
+        'metric-path': metric_path
+    }
+    logger.debug('path: ' + path + ', metric-path: ' + metric_path)
+    response = target.get_client().get(path, params=query_prams)
     response.raise_for_status();
-    logger.debug('response: ' + str(response.json()))
-    folders = response.json()
+    return response.json()
+
+
+def cache_metric_folders(cache, target, listings):
+    """caches the fresh listings, a dict of metric path to folders, with one write of the metric cache"""
+    if cache is None or not listings:
+        return
+    metrics.inc('pcf_dash_metric_cache_total', len(listings), help_text='metric browser listings served from the '
+                'cache (hit) or the controller (miss)', result='miss')
+    cache.put_many(get_metric_cache_scope(target), listings)
+
+
+def get_metric_folders(target, metric_path, refresh=False):
+    """lists the metric path, from the metric cache unless refresh is set or the cached listing has expired"""
+    cache = get_metric_cache()
+    folders = get_cached_metric_folders(cache, target, metric_path, refresh)
+    if folders is None:
+        folders = list_metric_folders(target, metric_path)
+        cache_metric_folders(cache, target, {metric_path: folders})
+    return folders
+
+
+def get_metric_folders_concurrently(target, metric_paths, refresh=False):
+    """lists the given metric paths using a bounded pool of workers; results are returned in the same order
 
+    cached listings are used as by get_metric_folders(), and the fresh listings are cached together once all are listed
+    """
+    if not metric_paths:
+        return []
+    cache = get_metric_cache()
+    folders = [get_cached_metric_folders(cache, target, metric_path, refresh) for metric_path in metric_paths]
+    to_list = [metric_path for metric_path, cached in zip(metric_paths, folders) if cached is None]
+    if not to_list:
+        return folders
+    max_workers = max(1, min(AppConfig.discovery_max_workers, len(to_list)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = dict(zip(to_list, executor.map(lambda metric_path: list_metric_folders(target, metric_path),
+                                                  to_list)))
+    cache_metric_folders(cache, target, listings)
+    return [listings[metric_path] if cached is None else cached for metric_path, cached in zip(metric_paths, folders)]
+
+
+def get_system_metrics_parent_folder(target, refresh=False):
+    metric_path_root = get_system_metrics_root_path(target)
+    folders = get_metric_folders(target, metric_path_root, refresh)
     logger.debug('folders: ' + str(folders))
 
+    candidate_folders = [str(folder['name']) for folder in folders if re.match('cf-\w+', str(folder['name']), re.I)]
+    logger.debug('candidate folders: ' + str(candidate_folders))
+    test_paths = [metric_path_root + '|' + folder + '|diego_cell' for folder in candidate_folders]
+    test_results = get_metric_folders_concurrently(target, test_paths, refresh)
+
     resource_parent_folder = None
-    for folder in folders:
-        if re.match('cf-\w+', str(folder['name']), re.I):
-            logger.debug('name: ' + str(folder['name']))
-            test_url = AppConfig.controller_url + '/controller/rest/applications/' + AppConfig.app + '/metrics' + query_prams + '|' + str(folder['name']) + '|diego_cell'
-            logger.debug('test_url: ' + test_url)
-            test_response = requests.get(test_url, auth=(AppConfig.get_full_user_name(), AppConfig.user_pass))
-            response.raise_for_status();            
-            logger.debug('test_response: ' + str(test_response.json()))
-            if not len(test_response.json()) == 0:
-                resource_parent_folder = str(folder['name'])
+    for folder, test_result in zip(candidate_folders, test_results):
+        logger.debug('folder: ' + folder + ', diego_cell entries: ' + str(len(test_result)))
+        if not len(test_result) == 0:
+            resource_parent_folder = folder
     if resource_parent_folder is None:
-        raise RuntimeError("unable to locate resource metrics parent folder using url: " + url)
+        raise RuntimeError("unable to locate resource metrics parent folder using metric path: " + metric_path_root)
     return resource_parent_folder
 
 
-def get_pcf_services(system_metrics_parent_folder):
+def get_pcf_services(target, system_metrics_parent_folder, refresh=False):
     logger.info('getting pcf service details from controller')
 
-    metric_path_root = 'Application Infrastructure Performance|' + AppConfig.tier +\
-                       '|Custom Metrics|PCF Firehose Monitor|System (BOSH) Metrics|bosh-system-metrics-forwarder|' +\
-                       system_metrics_parent_folder
+    metric_path_root = get_system_metrics_root_path(target) + '|' + system_metrics_parent_folder
+    pcf_service_list = get_metric_folders(target, metric_path_root, refresh)
+    logger.debug('response: + ' + str(pcf_service_list))
+    if len(pcf_service_list) == 0:
+        raise RuntimeError("unable to get list of pcf services using metric path: " + metric_path_root)
 
-    query_prams='?output=json&metric-path=' + metric_path_root
-    url = AppConfig.controller_url + '/controller/rest/applications/' + AppConfig.app + '/metrics' + query_prams
-    logger.debug('url: ' + url)
-    response = requests.get(url, auth=(AppConfig.get_full_user_name(), AppConfig.user_pass))
-    response.raise_for_status();
-    logger.debug('response: + ' + str(response.json()))
-    if len(response.json()) == 0:
-        raise RuntimeError("unable to get list of pcf services using url: " + url)
+    service_names = [pcf_service['name'] for pcf_service in pcf_service_list]
+    service_paths = [metric_path_root + '|' + service_name for service_name in service_names]
     pcf_services = {}
-    pcf_service_list = response.json()
-
-    for pcf_service in pcf_service_list:
-        service_name = pcf_service['name']
-        logger.debug('service: ' + service_name)
-        pcf_service_metric_path = metric_path_root + '|' + service_name
-        query_prams='?output=json&metric-path=' + pcf_service_metric_path
-        service_url = AppConfig.controller_url + '/controller/rest/applications/' + AppConfig.app + '/metrics' +\
-                      query_prams
-        logger.debug('service_url: ' + service_url)
-        response = requests.get(service_url, auth=(AppConfig.get_full_user_name(), AppConfig.user_pass))
-        response.raise_for_status();
-        service_instances = response.json()
-        logger.debug('nbr of instances: ' + str(len(service_instances)))
-        pcf_services[service_name] = [dict() for x in range(len(service_instances))]
-        for i, service_instance in enumerate(service_instances):
-            logger.debug('service instance: ' + str(service_instance))
-            guid = service_instance['name']
-            pcf_services[service_name][i] = {'guid' : guid}
+    for service_name, service_instances in zip(service_names, get_metric_folders_concurrently(target, service_paths,
+                                                                                              refresh)):
+        logger.debug('service: ' + service_name + ', nbr of instances: ' + str(len(service_instances)))
+        pcf_services[service_name] = [{'guid': service_instance['name']} for service_instance in service_instances]
     return pcf_services
 
 
@@ -198,6 +435,7 @@ def get_template_keyvalues(pcf_services, system_metrics_parent_folder, app, tier
     for pcf_service_name in PCF_SERVICE_NAMES:
         service_vms = pcf_services[pcf_service_name]
         logger.debug('service vms: ' + str(service_vms))        
+        keyvalues[pcf_service_name.upper() + '_COUNT'] = len(service_vms)
         for i, service_vm in enumerate(service_vms):
             logger.debug('service vm guid: ' + service_vm['guid'])
             keyvalues[pcf_service_name.upper() + '_' + str(i) + '_GUID'] = service_vm['guid']
@@ -207,42 +445,108 @@ def get_template_keyvalues(pcf_services, system_metrics_parent_folder, app, tier
 
 def generate_dashboard(template_keyvalues):
     logger.info('generating dashboard from template')
-    with open(pcf_dash_template_file, 'r', encoding='utf-8') as myfile:
-        dash_template=myfile.read()
-    dash_template = Template(dash_template)
-    generated = dash_template.substitute(template_keyvalues)
+    generated = template_registry.render(pcf_dash_template_file, template_keyvalues)
     #logger.debug('generated: ' + generated)        
     return generated
 
 
 def generate_healthrules(template_keyvalues):
     logger.info('generating health rules from template')
-    with open(pcf_hrs_template_file, 'r', encoding='utf-8') as myfile:
-        hr_template=myfile.read()
-    hr_template = Template(hr_template)
-    generated = hr_template.substitute(template_keyvalues)
+    generated = template_registry.render(pcf_hrs_template_file, template_keyvalues)
     return generated
 
 
-def dashboard_already_exists():
-    dash_name_template = Template(DASHBOARD_NAME)
-    dash_name = dash_name_template.substitute(APPLICATION_NAME=AppConfig.app, TIER_NAME=AppConfig.tier)
+def generate_dashboard_chunks(template_keyvalues):
+    """renders the dashboard as utf-8 chunks instead of one string, see generate_dashboard()"""
+    logger.debug('generating dashboard chunks from template')
+    return template_registry.render_chunks(pcf_dash_template_file, template_keyvalues)
+
+
+def generate_healthrules_chunks(template_keyvalues):
+    """renders the health rules as utf-8 chunks instead of one string, see generate_healthrules()"""
+    logger.debug('generating health rules chunks from template')
+    return template_registry.render_chunks(pcf_hrs_template_file, template_keyvalues)
+
+
+def write_generated_file(file_name, chunks):
+    """written aside and renamed, so that a failed render doesn't leave a partial file behind"""
+    try:
+        with open(file_name + '.tmp', 'wb') as myfile:
+            for chunk in chunks:
+                myfile.write(chunk)
+    except BaseException:
+        if os.path.exists(file_name + '.tmp'):
+            os.remove(file_name + '.tmp')
+        raise
+    os.replace(file_name + '.tmp', file_name)
+
+
+def get_snapshot_file(snapshot_dir, target):
+    return os.path.join(snapshot_dir, re.sub('[^\\w.-]', '_', target.name) + SNAPSHOT_SUFFIX)
+
+
+def write_discovery_snapshot(snapshot_file, target, system_metrics_parent_folder, pcf_services):
+    """records the discovered parent folder and service instance guids with the target's app and tier"""
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'name': target.name,
+        'app': target.app,
+        'tier': target.tier,
+        'tier_id': target.tier_id,
+        'system_metrics_parent_folder': system_metrics_parent_folder,
+        'pcf_services': {service_name: [service_vm['guid'] for service_vm in service_vms]
+                         for service_name, service_vms in pcf_services.items()}
+    }
+    os.makedirs(os.path.dirname(snapshot_file) or '.', exist_ok=True)
+    with open(snapshot_file + '.tmp', 'w', encoding='utf-8') as myfile:
+        json.dump(snapshot, myfile, sort_keys=True, separators=(',', ':'))
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+    logger.info('recorded discovery snapshot: ' + snapshot_file)
+
+
+def read_discovery_snapshot(snapshot_file):
+    """returns the snapshot with its pcf_services in the form returned by get_pcf_services()"""
+    with open(snapshot_file, 'r', encoding='utf-8') as myfile:
+        snapshot = json.load(myfile)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError('unsupported snapshot version ' + str(snapshot.get('version')) + ': ' + snapshot_file)
+    snapshot['pcf_services'] = {service_name: [{'guid': guid} for guid in guids]
+                                for service_name, guids in snapshot['pcf_services'].items()}
+    return snapshot
+
+
+def render_snapshot(snapshot_file, output_dir):
+    """renders the dashboard and hrs of a discovery snapshot into output_dir without accessing the controller;
+    returns the generated files"""
+    snapshot = read_discovery_snapshot(snapshot_file)
+    template_keyvalues = get_template_keyvalues(snapshot['pcf_services'], snapshot['system_metrics_parent_folder'],
+                                                snapshot['app'], snapshot['tier'], snapshot['tier_id'])
+    prefix = re.sub('[^\\w.-]', '_', snapshot['name']) + '-'
+    dashboard_file = os.path.join(output_dir, prefix + os.path.basename(pcf_dash_generated_file))
+    healthrules_file = os.path.join(output_dir, prefix + os.path.basename(pcf_hrs_generated_file))
+    write_generated_file(dashboard_file, generate_dashboard_chunks(template_keyvalues))
+    write_generated_file(healthrules_file, generate_healthrules_chunks(template_keyvalues))
+    return [dashboard_file, healthrules_file]
+
+
+def get_dashboard_name(target):
+    return Template(DASHBOARD_NAME).substitute(APPLICATION_NAME=target.app, TIER_NAME=target.tier)
+
+
+def dashboard_already_exists(target, refresh=False):
+    """looks the dashboard up in the controller's dashboard index, which is listed again when older than
+    AppConfig.dashboard_index_ttl or with refresh"""
+    dash_name = get_dashboard_name(target)
     logger.info('checking if dashboard already exists on controller with name: ' + dash_name)
-    session = requests.Session()
-    session.auth=AppConfig.get_full_user_name(), AppConfig.user_pass
-    login = session.get(AppConfig.controller_url + '/controller/auth?action=login')
-    session.headers['X-CSRF-TOKEN'] = login.cookies['X-CSRF-TOKEN']
-    url = AppConfig.controller_url + '/controller/restui/dashboards/getAllDashboardsByType/false'
-    logger.debug('url: ' + url)
-    response = session.get(url)
-    logger.debug('response: ' + str(response.json()))
-    response.raise_for_status();
-    dashboards = response.json()
-    for dashboard in dashboards:
-        logger.debug('name: ' + dashboard['name'])
-        if dashboard['name'] == dash_name:
-            return True
-    return False
+    return target.get_dashboard_index().exists(target.get_client(), dash_name, refresh)
+
+
+def get_uploaded_dashboard_id(response):
+    """the id of the imported dashboard, if the controller's response includes it"""
+    try:
+        return response.json()['dashboard']['id']
+    except (ValueError, KeyError, TypeError):
+        return None
 
 
 def return_last_value(last_attempt):
@@ -253,35 +557,41 @@ def is_false(value):
     return value is False
 
 
-@retry(wait=wait_exponential(max=PUBLISH_MAX_RETRY_DELAY_SECONDS),
-       stop=stop_after_attempt(PUBLISH_MAX_RETRIES),
-       retry=retry_if_result(is_false),
-       retry_error_callback=return_last_value)
-def pcf_metric_path_exists_with_retry():
-    return pcf_metric_path_exists()
+def record_metric_path_retry(*args, **kwargs):
+    metrics.inc('pcf_dash_metric_path_retries_total', help_text='retries of the pcf metric path check')
+
+
+def pcf_metric_path_exists_with_retry(target, refresh=False):
+    from tenacity import Retrying, wait_exponential, stop_after_attempt, retry_if_result
+    retrying = Retrying(wait=wait_exponential(max=PUBLISH_MAX_RETRY_DELAY_SECONDS),
+                        stop=stop_after_attempt(PUBLISH_MAX_RETRIES),
+                        retry=retry_if_result(is_false),
+                        retry_error_callback=return_last_value,
+                        before_sleep=record_metric_path_retry)
+    return retrying(pcf_metric_path_exists, target, refresh)
 
 
-def pcf_metric_path_exists():
-    metric_path_root = 'Application Infrastructure Performance|' + AppConfig.tier +\
-                       '|Custom Metrics|PCF Firehose Monitor|System (BOSH) Metrics|bosh-system-metrics-forwarder'
+def pcf_metric_path_exists(target, refresh=False):
+    """with refresh, the metric cache is bypassed and the root is listed again"""
+    from requests.exceptions import HTTPError
+    metric_path_root = get_system_metrics_root_path(target)
+    # a cached, non-empty listing of the root shows that the path exists
+    if get_cached_metric_folders(get_metric_cache(), target, metric_path_root, refresh):
+        return True
     query_prams = {
         'output': 'json',
         'metric-path': metric_path_root
     }
-    url = AppConfig.controller_url + '/controller/rest/applications/' + AppConfig.app + '/metrics'
-    logger.debug('url: ' + url)
+    path = '/controller/rest/applications/' + target.app + '/metrics'
+    logger.debug('path: ' + path)
     response = None
     try:
-        session = requests.Session()
-        session.auth = (AppConfig.get_full_user_name(), AppConfig.user_pass)
-        if os.getenv('APPD_MA_SSL_ENABLED') == 'true':
-            session.verify = 'cert.pem'
-        response = session.get(url, params=query_prams)
+        response = target.get_client().get(path, params=query_prams)
         response.raise_for_status()
         if response is not None: logger.debug('response: ' + str(response.json()))
     except HTTPError as err:
         if err.response.status_code == 400 and 'invalid application' in err.response.reason.lower():
-            logger.debug('application \'%s\' doesn\'t exist', AppConfig.app)
+            logger.debug('application \'%s\' doesn\'t exist', target.app)
             return False
     if response is None:
         return False
@@ -293,103 +603,538 @@ def pcf_metric_path_exists():
     return True
 
 
-def check_pcf_metric_path_exists(retry=False):
+def check_pcf_metric_path_exists(target, retry=False, refresh=False):
     if retry:
-        metric_path_exists = pcf_metric_path_exists_with_retry()
+        metric_path_exists = pcf_metric_path_exists_with_retry(target, refresh)
     else:
-        metric_path_exists = pcf_metric_path_exists()
+        metric_path_exists = pcf_metric_path_exists(target, refresh)
     if not metric_path_exists:
         msg = 'error: failed to find PCF metric path in target controller required to publish dashboard'
         logger.error(msg)
         raise MetricPathNotFound(msg)
 
 
-def upload_healthrules(healthrules_xml, overwrite_hrs):
-    logger.info('uploading health rules to controller (overwrite_hrs=' + str(AppConfig.overwrite_hrs) + ')')
-    url = AppConfig.controller_url + '/controller/healthrules/' + AppConfig.app
+def upload_healthrules(target, get_healthrules_chunks, overwrite_hrs):
+    """get_healthrules_chunks returns a new iterable of the utf-8 chunks of the health rules xml on each call"""
+    logger.info('uploading health rules to controller (overwrite_hrs=' + str(overwrite_hrs) + ')')
+    path = '/controller/healthrules/' + target.app
     if overwrite_hrs:
-        url += "?overwrite=true"
-    logger.debug('url: ' + url)
-    response = requests.post(url, auth=(AppConfig.get_full_user_name(), AppConfig.user_pass),
-                             files={'file':healthrules_xml})
+        path += "?overwrite=true"
+    logger.debug('path: ' + path)
+    response = target.get_client().post_file(path, get_healthrules_chunks, compress=AppConfig.gzip_uploads)
     response.raise_for_status();
     logger.debug('response: ' + str(response.content))
 
 
-def upload_dashboard(dashboard_json, recreate_dashboard):
+def read_controller_healthrules(target, parse):
+    """streams the controller's health rule export of the app into parse(chunks) and returns its result"""
+    path = '/controller/healthrules/' + target.app
+    logger.debug('path: ' + path)
+    response = target.get_client().get(path, stream=True)
+    try:
+        response.raise_for_status()
+        return parse(response.iter_content(HEALTHRULES_EXPORT_CHUNK_SIZE))
+    finally:
+        response.close()
+
+
+def reconcile_healthrules(target, get_healthrules_chunks, overwrite_hrs):
+    """uploads only the generated health rules that are missing on the controller, or that differ from the
+    controller's copy when overwrite_hrs is set; returns the names of the uploaded health rules
+
+    both documents are compared one health rule at a time by digest, and the rules to upload are streamed out of the
+    rendered health rules again, so that neither document is held in memory as a whole
+    """
+    from requests.exceptions import RequestException
+    generated = get_healthrule_digests(get_healthrules_chunks())
+    try:
+        current = read_controller_healthrules(target, get_healthrule_digests)
+    except (RequestException, ElementTree.ParseError) as e:
+        logger.warning('unable to read current health rules from controller, uploading all: ' + str(e))
+        upload_healthrules(target, get_healthrules_chunks, overwrite_hrs)
+        return list(generated)
+    diff = diff_healthrules(generated, current)
+    logger.info('health rule diff for target ' + target.name + ': ' + str(diff))
+    to_upload = diff.added + diff.changed if overwrite_hrs else diff.added
+    logger.info('skipping ' + str(len(diff.unchanged)) + ' unchanged health rules')
+    if diff.changed and not overwrite_hrs:
+        logger.info('skipping ' + str(len(diff.changed)) + ' changed health rules (overwrite_hrs=False)')
+        logger.debug('skipped changed health rules: ' + ', '.join(diff.changed))
+    if not to_upload:
+        logger.info('health rules are up to date on controller, nothing to upload')
+        return []
+    logger.debug('uploading health rules: ' + ', '.join(to_upload))
+    if len(to_upload) == len(generated):
+        # e.g. the first publish to an app, which doesn't need the rendered health rules parsed again
+        upload_healthrules(target, get_healthrules_chunks, overwrite_hrs)
+    else:
+        upload_healthrules(target, lambda: iter_healthrules_xml(get_healthrules_chunks(), to_upload), overwrite_hrs)
+    return to_upload
+
+
+def get_healthrule_names(healthrules_xml):
+    return [name for root, name, healthrule in iter_healthrules(healthrules_xml)]
+
+
+def get_controller_healthrule_names(target):
+    return read_controller_healthrules(target, get_healthrule_names)
+
+
+def log_hr_readiness(target, ready, elapsed, polls):
+    os.makedirs(AppConfig.state_dir, exist_ok=True)
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'target': target.name,
+        'app': target.app,
+        'tier': target.tier,
+        'ready': ready,
+        'elapsed_seconds': round(elapsed, 3),
+        'polls': polls
+    }
+    with open(os.path.join(AppConfig.state_dir, HR_READY_LOG_FILE), 'a', encoding='utf-8') as myfile:
+        myfile.write(json.dumps(entry) + '\n')
+
+
+def wait_for_healthrules(target, healthrule_names, max_wait):
+    """polls the controller's health rule export with exponential backoff until all of the given rules are listed"""
+    from requests.exceptions import RequestException
+    logger.debug('waiting up to %s seconds for %s health rules to be saved', str(max_wait), str(len(healthrule_names)))
+    expected = set(healthrule_names)
+    start = time.time()
+    delay = HR_READY_INITIAL_POLL_SECONDS
+    polls = 0
+    ready = False
+    while True:
+        polls += 1
+        try:
+            missing = expected.difference(get_controller_healthrule_names(target))
+            ready = len(missing) == 0
+            logger.debug('health rules not yet saved: ' + str(len(missing)))
+        except (RequestException, ElementTree.ParseError) as e:
+            logger.debug('unable to read health rules from controller: ' + str(e))
+        remaining = max_wait - (time.time() - start)
+        if ready or remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay *= 2
+    elapsed = time.time() - start
+    if ready:
+        logger.info('health rules saved after %.1f seconds (%s polls)', elapsed, str(polls))
+    else:
+        logger.warning('health rules not confirmed after %.1f seconds, continuing', elapsed)
+    log_hr_readiness(target, ready, elapsed, polls)
+    return ready
+
+
+def upload_dashboard(target, get_dashboard_chunks, recreate_dashboard):
+    """get_dashboard_chunks returns a new iterable of the utf-8 chunks of the dashboard json on each call"""
     logger.info('uploading dashboard to controller')
-    if not recreate_dashboard and dashboard_already_exists():
+    if not recreate_dashboard and dashboard_already_exists(target):
         logger.info('dashboard already exists on controller, will not recreate (recreate_dashboard=' + str(recreate_dashboard) + ')', )
         return
-    url = AppConfig.controller_url + '/controller/CustomDashboardImportExportServlet'
-    logger.debug('url: ' + url)
-    response = requests.post(url, auth=(AppConfig.get_full_user_name(), AppConfig.user_pass),
-                             files={'file':dashboard_json})
+    path = '/controller/CustomDashboardImportExportServlet'
+    logger.debug('path: ' + path)
+    response = target.get_client().post_file(path, get_dashboard_chunks, compress=AppConfig.gzip_uploads)
     response.raise_for_status();
     logger.debug('response status code: ' + str(response.status_code))
+    target.get_dashboard_index().add(get_dashboard_name(target), get_uploaded_dashboard_id(response))
+
+
+def get_publish_fingerprint(template_keyvalues):
+    """hash of everything that determines the generated dashboard and hrs: the discovered key/values and templates"""
+    fingerprint = hashlib.sha256(json.dumps(template_keyvalues, sort_keys=True).encode('utf-8'))
+    for template_file in (pcf_dash_template_file, pcf_hrs_template_file):
+        fingerprint.update(template_registry.get(template_file).source_hash.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def get_fingerprint_file(target):
+    target_key = '|'.join((target.controller_url, target.account_name, target.app, target.tier))
+    return os.path.join(AppConfig.state_dir,
+                        'fingerprint-' + hashlib.sha1(target_key.encode('utf-8')).hexdigest() + '.txt')
+
+
+def read_published_fingerprint(target):
+    try:
+        with open(get_fingerprint_file(target), 'r', encoding='utf-8') as myfile:
+            return myfile.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_published_fingerprint(target, fingerprint):
+    fingerprint_file = get_fingerprint_file(target)
+    os.makedirs(os.path.dirname(fingerprint_file), exist_ok=True)
+    with open(fingerprint_file + '.tmp', 'w', encoding='utf-8') as myfile:
+        myfile.write(fingerprint)
+    os.replace(fingerprint_file + '.tmp', fingerprint_file)
+
+
+@contextmanager
+def publish_phase(progress, target, phase):
+    """reports the phase to the progress callback and records its duration"""
+    logger.debug('publish phase: ' + phase)
+    if progress is not None:
+        progress(phase)
+    with metrics.timed('pcf_dash_phase_duration_seconds', help_text='duration of each publish phase',
+                       target=target.name, phase=phase):
+        yield
+
+
+def record_publish_outcome(target, outcome, duration):
+    metrics.inc('pcf_dash_publish_total', help_text='publish cycles by outcome (published, unchanged or failed)',
+                target=target.name, outcome=outcome)
+    metrics.set('pcf_dash_last_publish_timestamp_seconds', time.time(), help_text='end time of the last publish cycle',
+                target=target.name)
+    metrics.set('pcf_dash_last_publish_duration_seconds', duration, help_text='duration of the last publish cycle',
+                target=target.name)
+    metrics.set('pcf_dash_last_publish_success', 0 if outcome == 'failed' else 1,
+                help_text='1 if the last publish cycle succeeded', target=target.name)
+    metrics.set('pcf_dash_last_publish_uploaded', 1 if outcome == 'published' else 0,
+                help_text='1 if the last publish cycle uploaded the dashboard and health rules', target=target.name)
+    dump_metrics(metrics, AppConfig.get_metrics_dir(), AppConfig.process_role)
+
+
+def get_generated_file(generated_file, target):
+    """the generated files are prefixed with the target name when there is more than one target"""
+    if len(AppConfig.targets) <= 1:
+        return generated_file
+    directory, file_name = os.path.split(generated_file)
+    return os.path.join(directory, re.sub('[^\\w.-]', '_', target.name) + '-' + file_name)
+
+
+def publish_dashboard_and_hrs(retry=False, recreate_dashboard=False, overwrite_hrs=False, force=False, progress=None,
+                              target=None):
+    """returns False if the foundation and templates are unchanged since the last publish and nothing was uploaded
+
+    progress is an optional callback that is passed the name of each phase as it starts; target defaults to the only
+    configured target
+    """
+    if target is None:
+        target = AppConfig.get_target()
+    start = time.time()
+    outcome = 'failed'
+    try:
+        published = publish_target(target, retry, recreate_dashboard, overwrite_hrs, force, progress)
+        outcome = 'published' if published else 'unchanged'
+        return published
+    finally:
+        record_publish_outcome(target, outcome, time.time() - start)
 
 
-def publish_dashboard_and_hrs(retry=False, recreate_dashboard=False, overwrite_hrs=False):
-    logger.info('publishing pcf dashboards and hrs')
-    check_pcf_metric_path_exists(retry)
-    system_metrics_parent_folder = get_system_metrics_parent_folder()
-    logger.debug('system_metrics_parent_folder: ' + str(system_metrics_parent_folder))
-    pcf_services = get_pcf_services(system_metrics_parent_folder)
+def discover_target(target, retry, progress, refresh=False):
+    """returns the system metrics parent folder and pcf services of the target, recording them in a snapshot if
+    AppConfig.snapshot_dir is set; with refresh, the metric cache is bypassed"""
+    with publish_phase(progress, target, 'check_metric_path'):
+        check_pcf_metric_path_exists(target, retry, refresh)
+    try:
+        with publish_phase(progress, target, 'discover_parent_folder'):
+            system_metrics_parent_folder = get_system_metrics_parent_folder(target, refresh)
+        logger.debug('system_metrics_parent_folder: ' + str(system_metrics_parent_folder))
+        with publish_phase(progress, target, 'discover_services'):
+            pcf_services = get_pcf_services(target, system_metrics_parent_folder, refresh)
+    except Exception:
+        # the next discovery of the target walks the whole metric tree again
+        cache = get_metric_cache()
+        if cache is not None:
+            cache.clear(get_metric_cache_scope(target))
+        raise
     logger.debug('pcf_services: ' + str(pcf_services))
+    if AppConfig.snapshot_dir:
+        with publish_phase(progress, target, 'record_snapshot'):
+            write_discovery_snapshot(get_snapshot_file(AppConfig.snapshot_dir, target), target,
+                                     system_metrics_parent_folder, pcf_services)
+    return system_metrics_parent_folder, pcf_services
+
+
+def publish_target(target, retry, recreate_dashboard, overwrite_hrs, force, progress):
+    logger.info('publishing pcf dashboards and hrs for target: ' + target.name)
+    system_metrics_parent_folder, pcf_services = discover_target(target, retry, progress, refresh=force)
     template_keyvalues = get_template_keyvalues(pcf_services, system_metrics_parent_folder, 
-                                                AppConfig.app, AppConfig.tier, AppConfig.tier_id)    
-    dashboard = generate_dashboard(template_keyvalues)
-    healthrules = generate_healthrules(template_keyvalues)
+                                                target.app, target.tier, target.tier_id)    
+    with publish_phase(progress, target, 'change_detection'):
+        fingerprint = get_publish_fingerprint(template_keyvalues)
+        unchanged = not (force or recreate_dashboard or overwrite_hrs) and \
+            fingerprint == read_published_fingerprint(target) and dashboard_already_exists(target)
+    if unchanged:
+        logger.info('foundation and templates unchanged since last publish (fingerprint=' + fingerprint +
+                    '), skipping generation and upload')
+        return False
+    # the dashboard and hrs are rendered in chunks straight into the files and upload bodies that consume them
+    get_dashboard_chunks = partial(generate_dashboard_chunks, template_keyvalues)
+    get_healthrules_chunks = partial(generate_healthrules_chunks, template_keyvalues)
     if AppConfig.commandline and not AppConfig.start_service:
-        logger.debug('writing generated dashboard and hrs to file system')
-        with open(pcf_dash_generated_file, 'w', encoding='utf-8') as myfile:
-            myfile.write(dashboard)
-        with open(pcf_hrs_generated_file, 'w', encoding='utf-8') as myfile:
-            myfile.write(healthrules)
-    upload_healthrules(healthrules, overwrite_hrs)
-    logger.debug('sleeping %s seconds for health rules to be saved', str(DELAY_AFTER_HR_UPLOAD_SECONDS))
-    time.sleep(DELAY_AFTER_HR_UPLOAD_SECONDS)
-    upload_dashboard(dashboard, recreate_dashboard)
-    logger.info('done publishing pcf dashboards and hrs')
+        with publish_phase(progress, target, 'write_generated_files'):
+            logger.debug('writing generated dashboard and hrs to file system')
+            write_generated_file(get_generated_file(pcf_dash_generated_file, target), get_dashboard_chunks())
+            write_generated_file(get_generated_file(pcf_hrs_generated_file, target), get_healthrules_chunks())
+    with publish_phase(progress, target, 'upload_healthrules'):
+        uploaded_healthrules = reconcile_healthrules(target, get_healthrules_chunks, overwrite_hrs)
+    if uploaded_healthrules:
+        with publish_phase(progress, target, 'wait_for_healthrules'):
+            wait_for_healthrules(target, uploaded_healthrules, AppConfig.hr_ready_max_wait)
+    with publish_phase(progress, target, 'upload_dashboard'):
+        upload_dashboard(target, get_dashboard_chunks, recreate_dashboard)
+    write_published_fingerprint(target, fingerprint)
+    logger.info('done publishing pcf dashboards and hrs for target: ' + target.name)
+    return True
 
 
-def start_flask():
-    logger.info('starting service on port ' + str(AppConfig.service_port))
-    service.run(debug=True, port=AppConfig.service_port)
+def publish_all_targets(retry=False, recreate_dashboard=None, overwrite_hrs=None, force=False):
+    """publishes every configured target, at most AppConfig.target_max_concurrency at a time
 
+    recreate_dashboard/overwrite_hrs of None use each target's own setting; returns a dict of target name to the
+    publish result, or to the exception raised while publishing that target
+    """
+    def publish_one(target):
+        try:
+            return publish_dashboard_and_hrs(retry,
+                                             target.recreate_dashboard if recreate_dashboard is None else recreate_dashboard,
+                                             target.overwrite_hrs if overwrite_hrs is None else overwrite_hrs,
+                                             force, target=target)
+        except Exception as e:
+            logger.exception('failed to publish target: ' + target.name)
+            return e
 
-@service.route('/pcf-dash/publish', methods=['POST'])
-def publish():
-    logger.info('request received: publish')
-    overwrite_hrs = request.args.get('overwrite_hrs') and request.args.get('overwrite_hrs').lower() == 'true'
-    recreate_dashboard = request.args.get('recreate_dashboard') and request.args.get('recreate_dashboard').lower() == 'true'    
-    retry = request.args.get('retry') and request.args.get('retry').lower() == 'true'
-    try:
-        publish_dashboard_and_hrs(retry, recreate_dashboard, overwrite_hrs)
-    except MetricPathNotFound as e:
-        logger.error(str(e))
-        return Response(str(e), 404)
-    return 'done'
+    max_workers = max(1, min(AppConfig.target_max_concurrency, len(AppConfig.targets)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(publish_one, AppConfig.targets))
+    return dict(zip([target.name for target in AppConfig.targets], results))
+
+
+def snapshot_all_targets(retry=False):
+    """records a discovery snapshot of every configured target without publishing; returns a dict of target name to
+    the snapshot file, or to the exception raised while discovering that target"""
+    def snapshot_one(target):
+        try:
+            discover_target(target, retry, None, refresh=AppConfig.force)
+            return get_snapshot_file(AppConfig.snapshot_dir, target)
+        except Exception as e:
+            logger.exception('failed to record snapshot of target: ' + target.name)
+            return e
+
+    max_workers = max(1, min(AppConfig.target_max_concurrency, len(AppConfig.targets)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(snapshot_one, AppConfig.targets))
+    return dict(zip([target.name for target in AppConfig.targets], results))
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+# queue of on-demand publish jobs run by the background refresh process, see set_publish_triggers()
+_publish_triggers = None
+
+
+def set_publish_triggers(triggers):
+    """publish jobs requested through the rest api are put on triggers, e.g. a multiprocessing.Queue created by the
+    gunicorn master before forking the workers, and run by the refresh scheduler of run_publisher() instead of by the
+    worker that received the request"""
+    global _publish_triggers
+    _publish_triggers = triggers
+
+
+def dispatch_publish_job(job):
+    _publish_triggers.put((job['params']['target_name'], job))
+
+
+def coalesce_publish_jobs(queued, job):
+    """merges a dispatched publish job into a queued job of the same target with the same params, for the
+    RefreshScheduler; the status of the queued job is also saved as the merged job's status, see run_refresh()
+
+    the service workers each coalesce the requests they receive, this merges the duplicates received by different
+    workers
+    """
+    if queued['params'] != job['params']:
+        return False
+    logger.info('coalescing publish job ' + job['id'] + ' into queued job ' + queued['id'])
+    queued.setdefault('merged', []).append(job['id'])
+    return True
+
+
+def get_jobs_dir():
+    return os.path.join(AppConfig.state_dir, 'jobs')
+
+
+def get_job_manager():
+    """created on first use so that the executor threads are started in the gunicorn worker, not the preloading master"""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = PublishJobManager(publish_job, max_workers=AppConfig.publish_job_max_workers,
+                                             jobs_dir=get_jobs_dir(),
+                                             dispatch=dispatch_publish_job if _publish_triggers is not None else None)
+        return _job_manager
+
+
+def publish_job(target_name, retry, recreate_dashboard, overwrite_hrs, force, progress=None):
+    return publish_dashboard_and_hrs(retry, recreate_dashboard, overwrite_hrs, force, progress,
+                                     AppConfig.get_target(target_name))
+
+
+def create_app():
+    """builds the flask app serving the rest api, e.g. gunicorn pcf_dash_generator:create_app()
+
+    reads the configuration from the environment unless the command line has already configured this process
+    """
+    from flask import Flask, request, Response, jsonify
+    if not AppConfig.configured:
+        start_app_pcf()
+    service = Flask(__name__)
+
+    def get_bool_arg(name):
+        value = request.args.get(name)
+        return value is not None and value.lower() == 'true'
+
+    @service.route('/pcf-dash/publish', methods=['POST'])
+    def publish():
+        logger.info('request received: publish')
+        overwrite_hrs = get_bool_arg('overwrite_hrs')
+        recreate_dashboard = get_bool_arg('recreate_dashboard')
+        retry = get_bool_arg('retry')
+        force = get_bool_arg('force')
+        try:
+            target = AppConfig.get_target(request.args.get('target'))
+        except KeyError as e:
+            # str() of a KeyError is the repr of its message
+            return Response(e.args[0], 400)
+        if get_bool_arg('wait') and _publish_triggers is None:
+            try:
+                publish_dashboard_and_hrs(retry, recreate_dashboard, overwrite_hrs, force, target=target)
+            except MetricPathNotFound as e:
+                logger.error(str(e))
+                return Response(str(e), 404)
+            return 'done'
+        job, coalesced = get_job_manager().submit((target.name,), target_name=target.name, retry=retry,
+                                                  recreate_dashboard=recreate_dashboard, overwrite_hrs=overwrite_hrs,
+                                                  force=force)
+        if get_bool_arg('wait'):
+            # the job may be queued behind a refresh of the target, which is bounded by the same deadline
+            finished = get_job_manager().wait(job.id, timeout=2 * AppConfig.refresh_deadline)
+            if finished is None or finished['status'] not in (JOB_SUCCEEDED, JOB_FAILED):
+                return Response('publish job ' + job.id + ' did not finish in time', 504)
+            if finished['status'] == JOB_FAILED:
+                logger.error(finished['error'])
+                status = 404 if finished['error'].startswith(MetricPathNotFound.__name__ + ':') else 500
+                return Response(finished['error'], status)
+            return 'done'
+        response = jsonify(job_id=job.id, status=job.status, coalesced=coalesced)
+        response.status_code = 202
+        response.headers['Location'] = '/pcf-dash/jobs/' + job.id
+        return response
+
+    @service.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        snapshots = collect_metrics(metrics, AppConfig.get_metrics_dir(), AppConfig.process_role)
+        return Response(to_prometheus(snapshots), 200, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @service.route('/pcf-dash/jobs/<job_id>', methods=['GET'])
+    def publish_job_status(job_id):
+        job = get_job_manager().get(job_id)
+        if job is None:
+            return Response('job not found: ' + job_id, 404)
+        return jsonify(job)
+
+    gunicorn_logger = logging.getLogger('gunicorn.error')
+    if gunicorn_logger.handlers:
+        service.logger.handlers = gunicorn_logger.handlers
+        service.logger.setLevel(gunicorn_logger.level)
+    return service
+
+
+def run_refresh(target_name, trigger, progress):
+    """runs a periodic refresh of the target, or the publish job dispatched as trigger, for the RefreshScheduler;
+    progress raises CycleCancelled once the run has passed its deadline"""
+    if trigger is None:
+        logger.debug('refreshing dashboard and health rules of target: ' + target_name)
+        publish_dashboard_and_hrs(retry=True, progress=progress, target=AppConfig.get_target(target_name))
+        return True
+    job = PublishJob.from_dict(trigger)
+    check_deadline = progress
+
+    def publish(progress, **params):
+        def on_phase(phase):
+            check_deadline(phase)
+            progress(phase)
+        return publish_job(progress=on_phase, **params)
+
+    jobs_dir = get_jobs_dir()
+
+    def save(job):
+        save_job_status(jobs_dir, job)
+        for job_id in trigger.get('merged', []):
+            save_job_status(jobs_dir, job, job_id)
+
+    logger.info('running publish job ' + job.id + ' of target: ' + target_name)
+    run_job(job, publish, save)
+    return job.status != JOB_FAILED
+
+
+def run_publisher(refresh_time_secs, triggers=None):
+    """refreshes the dashboards and hrs of all targets until terminated, e.g. in the background process started by the
+    gunicorn master (see service_config.py), and runs the publish jobs that the service workers put on triggers"""
+    import signal
+    from controller_client import reset_controller_clients
+    if not AppConfig.configured:
+        start_app_pcf()
+    # don't share pooled connections with the forking gunicorn master
+    reset_controller_clients()
+    AppConfig.process_role = 'publisher'
+    logger.info("Generating Dashboard using a separate process")
+    intervals = {target.name: float(target.refresh_interval or refresh_time_secs) for target in AppConfig.targets}
+    scheduler = RefreshScheduler(run_refresh, intervals, jitter=AppConfig.refresh_jitter,
+                                 splay=AppConfig.refresh_splay, max_backoff=AppConfig.refresh_max_backoff,
+                                 deadline=AppConfig.refresh_deadline,
+                                 max_workers=max(1, min(AppConfig.target_max_concurrency, len(AppConfig.targets))),
+                                 coalesce=coalesce_publish_jobs)
+    if triggers is not None:
+        scheduler.forward_triggers(triggers)
+    # stopped from another thread, as the signal interrupts the scheduler's own thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=scheduler.stop).start())
+    scheduler.run_forever()
+
+
+_logging_configured = False
+
+
+def configure_logging():
+    global _logging_configured
+    if not _logging_configured:
+        from logging.config import fileConfig
+        fileConfig(LOGGING_CONFIG_FILE)
+        _logging_configured = True
+
+
+def start_flask():
+    logger.info('starting service on port ' + str(AppConfig.service_port))
+    create_app().run(debug=True, port=AppConfig.service_port)
 
 
 def start_app_commandline():
+    configure_logging()
     AppConfig.commandline = True
     parse_args()
+    AppConfig.configured = True
     if AppConfig.start_service:
         logger.info('starting service')
         start_flask()
+    elif AppConfig.snapshot_only:
+        results = snapshot_all_targets()
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
     else:
-        publish_dashboard_and_hrs(retry=False, recreate_dashboard=AppConfig.recreate_dashboard, overwrite_hrs=AppConfig.overwrite_hrs)
+        results = publish_all_targets(retry=False, force=AppConfig.force)
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
 
 
 def start_app_pcf():
+    """configures logging and reads the configuration from the environment"""
+    configure_logging()
     parse_env()
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    if gunicorn_logger is not None:
-        service.logger.handlers = gunicorn_logger.handlers
-        service.logger.setLevel(gunicorn_logger.level)
+    AppConfig.configured = True
+
 
 if __name__ == '__main__':
     start_app_commandline()
-else:
-    start_app_pcf()
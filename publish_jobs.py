@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_HISTORY_SIZE = 100
+
+logger = logging.getLogger()
+
+
+class PublishJob(object):
+
+    def __init__(self, key, params):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.params = params
+        self.status = JOB_QUEUED
+        self.phase = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def is_done(self):
+        return self.status in (JOB_SUCCEEDED, JOB_FAILED)
+
+    @classmethod
+    def from_dict(cls, saved):
+        job = cls(tuple(saved['key']), saved['params'])
+        for name in ('id', 'status', 'phase', 'result', 'error', 'created', 'started', 'finished'):
+            setattr(job, name, saved[name])
+        return job
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'key': list(self.key),
+            'params': self.params,
+            'status': self.status,
+            'phase': self.phase,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+def get_job_file(jobs_dir, job_id):
+    return os.path.join(jobs_dir, job_id + '.json')
+
+
+def save_job_status(jobs_dir, job, job_id=None):
+    """saves the status of the job, as the status of job_id if given, e.g. a job that was coalesced into it"""
+    job_id = job_id or job.id
+    try:
+        os.makedirs(jobs_dir, exist_ok=True)
+        job_file = get_job_file(jobs_dir, job_id)
+        saved = job.to_dict()
+        saved['id'] = job_id
+        with open(job_file + '.tmp', 'w', encoding='utf-8') as myfile:
+            json.dump(saved, myfile)
+        os.replace(job_file + '.tmp', job_file)
+    except OSError as e:
+        logger.warning('unable to save status of job ' + job_id + ': ' + str(e))
+
+
+def run_job(job, publish_fn, save):
+    """runs the job, passing its status to save() as it changes; publish_fn(progress=..., **params) publishes"""
+    job.status = JOB_RUNNING
+    job.started = time.time()
+    save(job)
+
+    def set_phase(phase):
+        job.phase = phase
+        save(job)
+
+    try:
+        job.result = publish_fn(progress=set_phase, **job.params)
+        job.status = JOB_SUCCEEDED
+    except Exception as e:
+        logger.exception('publish job ' + job.id + ' failed')
+        job.error = type(e).__name__ + ': ' + str(e)
+        job.status = JOB_FAILED
+    job.finished = time.time()
+    save(job)
+
+
+class PublishJobManager(object):
+    """runs publish jobs on a bounded executor; a submit for a key/params that is already queued or running
+    returns the in-flight job instead of starting another run
+
+    job status is also written to jobs_dir so that any gunicorn worker can report it. With dispatch, jobs are not run
+    here but passed to dispatch(job dict), and whoever runs them reports their status with save_job_status()
+    """
+
+    def __init__(self, publish_fn, max_workers=1, jobs_dir=None, dispatch=None):
+        self.publish_fn = publish_fn
+        self.jobs_dir = jobs_dir
+        self.dispatch = dispatch
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._in_flight = {}
+
+    def submit(self, key, **params):
+        """returns (job, coalesced)"""
+        in_flight_key = (key, json.dumps(params, sort_keys=True))
+        with self._lock:
+            job = self._in_flight.get(in_flight_key)
+            if job is not None and self.dispatch is not None:
+                job = self._reload(job)
+                self._in_flight[in_flight_key] = job
+            if job is not None and not job.is_done():
+                logger.info('coalescing publish request for ' + str(key) + ' into job ' + job.id)
+                return job, True
+            job = PublishJob(key, params)
+            self._jobs[job.id] = job
+            self._in_flight[in_flight_key] = job
+            self._prune()
+        self._save(job)
+        if self.dispatch is not None:
+            self.dispatch(job.to_dict())
+        else:
+            self._executor.submit(self._run, job, in_flight_key)
+        return job, False
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and self.dispatch is None:
+                return job.to_dict()
+        return self._load(job_id)
+
+    def wait(self, job_id, timeout=None, poll_interval=0.5):
+        """returns the job once it is done, or as it is when the timeout elapses"""
+        start = time.time()
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in (JOB_SUCCEEDED, JOB_FAILED):
+                return job
+            if timeout is not None and time.time() - start >= timeout:
+                return job
+            time.sleep(poll_interval)
+
+    def _reload(self, job):
+        """dispatched jobs are run by another process, which saves their status in jobs_dir"""
+        saved = self._load(job.id)
+        if saved is None:
+            return job
+        job = PublishJob.from_dict(saved)
+        self._jobs[job.id] = job
+        return job
+
+    def _run(self, job, in_flight_key):
+        run_job(job, self.publish_fn, self._save)
+        with self._lock:
+            if self._in_flight.get(in_flight_key) is job:
+                del self._in_flight[in_flight_key]
+
+    def _prune(self):
+        if len(self._jobs) <= JOB_HISTORY_SIZE:
+            return
+        jobs = list(self._jobs.values())
+        if self.dispatch is not None:
+            jobs = [self._reload(job) for job in jobs]
+        done = sorted((job for job in jobs if job.is_done()), key=lambda job: job.created)
+        for job in done[:len(self._jobs) - JOB_HISTORY_SIZE]:
+            del self._jobs[job.id]
+            if self.jobs_dir:
+                try:
+                    os.remove(self._get_job_file(job.id))
+                except FileNotFoundError:
+                    pass
+
+    def _get_job_file(self, job_id):
+        return get_job_file(self.jobs_dir, job_id)
+
+    def _save(self, job):
+        if self.jobs_dir:
+            save_job_status(self.jobs_dir, job)
+
+    def _load(self, job_id):
+        if not self.jobs_dir or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self._get_job_file(job_id), 'r', encoding='utf-8') as myfile:
+                return json.load(myfile)
+        except (FileNotFoundError, ValueError):
+            return None
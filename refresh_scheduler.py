@@ -0,0 +1,172 @@
+import time
+import queue
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# the first failed run of a target is retried after this long, doubling with each further consecutive failure
+BACKOFF_BASE_SECONDS = 30
+
+logger = logging.getLogger()
+
+
+class CycleCancelled(Exception):
+    """raised at the next phase of a run that has passed its deadline or whose scheduler is stopping"""
+
+
+class TargetSchedule(object):
+
+    def __init__(self, name, interval, next_run):
+        self.name = name
+        self.interval = interval
+        self.next_run = next_run
+        self.failures = 0
+        self.running = False
+        # on-demand runs waiting for the target's current run to finish
+        self.triggers = []
+
+
+class RefreshScheduler(object):
+    """runs the periodic refresh of each target, and the runs triggered on demand, with at most one run per target at a
+    time
+
+    run(target_name, trigger, progress) performs a run; trigger is None for a periodic refresh, and progress must be
+    called at the start of each phase, which is where runs past the deadline are cancelled. It returns False or raises
+    if the run failed. Periodic runs are spread by the jitter (a fraction of the interval), the first run of each
+    target by a random delay of up to splay seconds, and a target whose runs fail is retried with exponential backoff of
+    up to max_backoff seconds. A successful on-demand run counts as the target's periodic refresh.
+
+    coalesce(queued, trigger), if given, is called for each trigger still queued for the target when another trigger
+    of the target arrives, and returns True if it merged the new trigger into the queued one, which is then not queued
+    again. Triggers are not merged into a running one, as that run may have started before the trigger was requested.
+    """
+
+    def __init__(self, run, intervals, jitter=0.1, splay=0.0, max_backoff=1800.0, deadline=None, max_workers=1,
+                 coalesce=None):
+        now = time.time()
+        self.run_target = run
+        self.coalesce = coalesce
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.max_workers = max_workers
+        self.schedules = {name: TargetSchedule(name, interval, now + random.uniform(0, splay))
+                          for name, interval in intervals.items()}
+        self._lock = threading.Lock()
+        self._events = queue.Queue()
+        self._stopping = threading.Event()
+
+    def trigger(self, target_name, trigger):
+        """queues an on-demand run of the target; may be called from any thread"""
+        self._events.put((target_name, trigger))
+
+    def forward_triggers(self, triggers):
+        """queues the (target name, trigger) pairs received from triggers, e.g. a multiprocessing.Queue that other
+        processes put on-demand runs on, until the scheduler stops"""
+        def forward():
+            while not self._stopping.is_set():
+                try:
+                    target_name, trigger = triggers.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.trigger(target_name, trigger)
+
+        thread = threading.Thread(target=forward, name='refresh-scheduler-triggers', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """stops scheduling runs and cancels the running ones at their next phase"""
+        self._stopping.set()
+        self._events.put(None)
+
+    def run_forever(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while not self._stopping.is_set():
+                self._receive_events(self._get_wait())
+                self._start_due_runs(executor)
+        logger.info('refresh scheduler stopped')
+
+    def _get_wait(self):
+        with self._lock:
+            next_runs = [schedule.next_run for schedule in self.schedules.values()
+                         if not schedule.running and not schedule.triggers]
+        return max(0.0, min(next_runs) - time.time()) if next_runs else None
+
+    def _receive_events(self, wait):
+        """waits up to wait seconds (forever if None) for a trigger or a finished run, then takes all queued events"""
+        try:
+            event = self._events.get(timeout=wait)
+        except queue.Empty:
+            return
+        while event is not None:
+            target_name, trigger = event
+            with self._lock:
+                schedule = self.schedules.get(target_name)
+                if schedule is not None and trigger is not None:
+                    self._queue_trigger(schedule, trigger)
+            if schedule is None:
+                logger.warning('ignoring trigger for unknown target: ' + str(target_name))
+            try:
+                event = self._events.get_nowait()
+            except queue.Empty:
+                return
+
+    def _queue_trigger(self, schedule, trigger):
+        """called with the lock"""
+        if self.coalesce is not None:
+            for queued in schedule.triggers:
+                if self.coalesce(queued, trigger):
+                    return
+        schedule.triggers.append(trigger)
+
+    def _start_due_runs(self, executor):
+        now = time.time()
+        with self._lock:
+            for schedule in self.schedules.values():
+                if schedule.running or self._stopping.is_set():
+                    continue
+                if schedule.triggers:
+                    trigger = schedule.triggers.pop(0)
+                elif schedule.next_run <= now:
+                    trigger = None
+                else:
+                    continue
+                schedule.running = True
+                executor.submit(self._run, schedule, trigger)
+
+    def _run(self, schedule, trigger):
+        deadline = time.time() + self.deadline if self.deadline else None
+
+        def progress(phase):
+            if self._stopping.is_set():
+                raise CycleCancelled('refresh scheduler stopping, cancelled before phase ' + phase)
+            if deadline is not None and time.time() > deadline:
+                raise CycleCancelled('deadline of ' + str(self.deadline) + 's passed, cancelled before phase ' + phase)
+
+        succeeded = False
+        try:
+            succeeded = self.run_target(schedule.name, trigger, progress) is not False
+        except CycleCancelled as e:
+            logger.warning('refresh of target ' + schedule.name + ' cancelled: ' + str(e))
+        except Exception:
+            logger.exception('refresh of target ' + schedule.name + ' failed')
+        with self._lock:
+            schedule.running = False
+            if succeeded:
+                schedule.failures = 0
+                delay = schedule.interval
+            elif trigger is None or schedule.failures > 0:
+                schedule.failures += 1
+                delay = min(BACKOFF_BASE_SECONDS * 2 ** (schedule.failures - 1), self.max_backoff)
+            else:
+                # a failed on-demand run doesn't delay the target's periodic refresh
+                delay = None
+            if delay is not None:
+                schedule.next_run = time.time() + delay * (1 + random.uniform(-self.jitter, self.jitter))
+                logger.info('next refresh of target ' + schedule.name + ' in ' +
+                            str(round(schedule.next_run - time.time())) + ' seconds' +
+                            (' (' + str(schedule.failures) + ' consecutive failures)' if schedule.failures else ''))
+        # wakes run_forever() to start the target's next queued trigger
+        self._events.put((schedule.name, None))
@@ -1,6 +1,9 @@
 import os
-import time
-from multiprocessing import Process
+import sys
+import signal
+import traceback
+from multiprocessing import Queue
+from multiprocessing.connection import wait
 
 bind = "0.0.0.0:{port}".format(port=os.getenv('VCAP_APP_PORT', '5000'))
 workers = 2
@@ -15,23 +18,71 @@ def write_cert_file():
         print(os.path.abspath("cert.pem"))
 
 
-def upload_hr_dashboard():
+def upload_hr_dashboard(triggers):
     import pcf_dash_generator
-    pcf_dash_generator.logger.info("Generating Dashboard using a separate thread")
-    while True:
-        try:
-            pcf_dash_generator.publish_dashboard_and_hrs(retry=True, recreate_dashboard=False, overwrite_hrs=False)
-        except KeyError as kexc:
-            pcf_dash_generator.logger.error('Key not found' + str(kexc))
-            
-        pcf_dash_generator.logger.info("Dashboard will be refreshed in {} seconds".format(REFRESH_TIME_SECS))
-        time.sleep(REFRESH_TIME_SECS)
-        pcf_dash_generator.logger.debug("Refreshing Dashboard and Health rules")
+    pcf_dash_generator.run_publisher(REFRESH_TIME_SECS, triggers)
+
+
+class Publisher(object):
+    """the background refresh process, forked directly rather than started as a multiprocessing.Process: multiprocessing
+    keeps the children it starts in a module global, which the workers forked from the master would inherit and try to
+    join or terminate when they exit
+
+    sentinel is a pipe that becomes readable once the process has exited, like multiprocessing.Process.sentinel; the
+    process itself is reaped by the gunicorn master along with its workers
+    """
+
+    def __init__(self, target, args=()):
+        self.target = target
+        self.args = args
+        self.pid = None
+        self.sentinel = None
+
+    def start(self):
+        sentinel, exit_pipe = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(sentinel)
+            exit_code = 1
+            try:
+                self.target(*self.args)
+                exit_code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # skips the master's atexit handlers; exit_pipe is closed with the process
+                os._exit(exit_code)
+        os.close(exit_pipe)
+        self.pid = pid
+        self.sentinel = sentinel
+
+    def terminate(self):
+        os.kill(self.pid, signal.SIGTERM)
 
 
 def when_ready(server):
     import pcf_dash_generator
     write_cert_file()
-    bootstrap_worker = Process(target=upload_hr_dashboard)
-    bootstrap_worker.start()
+    # created before the workers are forked, so that their publish requests go to the background refresh process
+    triggers = Queue()
+    pcf_dash_generator.set_publish_triggers(triggers)
+    publisher = Publisher(upload_hr_dashboard, (triggers,))
+    publisher.start()
+    # kept on the arbiter for on_exit(), as gunicorn re-reads this file (and resets its globals) on reload
+    server.publisher = publisher
     pcf_dash_generator.logger.info("Dashboard Ready!")
+
+
+def on_exit(server):
+    """stops the background refresh process when the master shuts down; its runs are cancelled at their next phase,
+    and it is killed if it hasn't exited within the graceful timeout"""
+    publisher = getattr(server, 'publisher', None)
+    if publisher is None or wait([publisher.sentinel], 0):
+        return
+    server.log.info('stopping background refresh process ' + str(publisher.pid))
+    publisher.terminate()
+    if not wait([publisher.sentinel], server.cfg.graceful_timeout):
+        server.log.warning('background refresh process ' + str(publisher.pid) + ' did not exit in time, killing it')
+        os.kill(publisher.pid, signal.SIGKILL)
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+import threading
+from string import Template
+
+COMPILED_TEMPLATE_SUFFIX = '.compiled.json'
+COMPILED_TEMPLATE_VERSION = 2
+# size of the utf-8 chunks yielded by render_chunks()
+RENDER_CHUNK_SIZE = 64 * 1024
+# large literals, e.g. the data uris of image widgets, are kept in a content addressed store next to the templates
+# and referenced as $[asset <sha256>], see utils/create_template.py
+ASSETS_DIR = 'assets'
+ASSET_SUFFIX = '.txt'
+# block directives, e.g. $[repeat diego_cell separator=","]...$[/repeat], see README "Template Expansion"
+DIRECTIVE_PATTERN = re.compile(r'\$\[(?P<directive>/?[a-z]+)(?P<args>(?:\s+\w+(?:="(?:[^"\\]|\\.)*")?)*)\s*\]')
+DIRECTIVE_ARG_PATTERN = re.compile(r'(\w+)(?:="((?:[^"\\]|\\.)*)")?')
+INSTANCE_GUID = 'INSTANCE_GUID'
+INSTANCE_INDEX = 'INSTANCE_INDEX'
+LEFT = 'LEFT'
+RIGHT = 'RIGHT'
+
+logger = logging.getLogger()
+
+_assets = {}
+_assets_lock = threading.Lock()
+
+
+class ScopedMapping(object):
+    """template key/values overlaid with the values of a block, without copying the (large) outer mapping"""
+
+    def __init__(self, parent, values):
+        self.parent = parent
+        self.values = values
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        return self.parent[key]
+
+    def __contains__(self, key):
+        return key in self.values or key in self.parent
+
+
+def get_instance_guids(mapping, service):
+    """the guids of a pcf service's instances as emitted by get_template_keyvalues(): <SERVICE>_<i>_GUID"""
+    prefix = service.upper() + '_'
+    guids = []
+    while prefix + str(len(guids)) + '_GUID' in mapping:
+        guids.append(mapping[prefix + str(len(guids)) + '_GUID'])
+    return guids
+
+
+class RepeatBlock(object):
+    """renders its body once per instance of a service, with ${INSTANCE_INDEX} and ${INSTANCE_GUID} set"""
+
+    def __init__(self, service, separator, body):
+        self.service = service
+        self.separator = separator
+        self.body = body
+
+    def iter_parts(self, mapping):
+        for i, guid in enumerate(get_instance_guids(mapping, self.service)):
+            if i > 0 and self.separator:
+                yield self.separator
+            yield from self.body.iter_parts(ScopedMapping(mapping, {INSTANCE_INDEX: i, INSTANCE_GUID: guid}))
+
+    def to_dict(self):
+        return {'repeat': self.service, 'separator': self.separator, 'body': self.body.to_dict()}
+
+
+class ReduceBlock(object):
+    """combines one leaf per instance of a service into a balanced tree of nodes, e.g. the PLUS expression summing a
+    metric over all diego cells; the node template refers to its subtrees as ${LEFT} and ${RIGHT}
+
+    the tree is balanced so that its depth grows with log(instances) and the output size linearly
+    """
+
+    def __init__(self, service, leaf, node):
+        self.service = service
+        self.leaf = leaf
+        self.node = node
+
+    def iter_parts(self, mapping):
+        guids = get_instance_guids(mapping, self.service)
+        if not guids:
+            raise KeyError(self.service.upper() + '_0_GUID')
+        return self._iter_tree(mapping, guids, 0, len(guids))
+
+    def _iter_tree(self, mapping, guids, start, end):
+        if end - start == 1:
+            yield from self.leaf.iter_parts(ScopedMapping(mapping, {INSTANCE_INDEX: start, INSTANCE_GUID: guids[start]}))
+            return
+        middle = (start + end + 1) // 2
+        node = self.node
+        for segment, slot in zip(node.segments, node.slots):
+            yield segment
+            if slot == LEFT:
+                yield from self._iter_tree(mapping, guids, start, middle)
+            elif slot == RIGHT:
+                yield from self._iter_tree(mapping, guids, middle, end)
+            else:
+                yield from iter_slot(slot, mapping)
+        yield node.segments[-1]
+
+    def to_dict(self):
+        return {'reduce': self.service, 'leaf': self.leaf.to_dict(), 'node': self.node.to_dict()}
+
+
+class Asset(str):
+    """an asset's text, with its utf-8 encoding kept so that render_chunks() can splice it in without copying"""
+
+    def __new__(cls, text):
+        asset = super(Asset, cls).__new__(cls, text)
+        asset.encoded = text.encode('utf-8')
+        return asset
+
+
+def get_asset_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def get_asset_file(assets_dir, digest):
+    return os.path.join(assets_dir, digest + ASSET_SUFFIX)
+
+
+def write_asset(assets_dir, text):
+    """stores the text under its sha256 digest, once, and returns the digest"""
+    digest = get_asset_digest(text)
+    asset_file = get_asset_file(assets_dir, digest)
+    if not os.path.exists(asset_file):
+        os.makedirs(assets_dir, exist_ok=True)
+        # written aside and renamed, as concurrent template builds may store the same asset
+        temp_file = asset_file + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as myfile:
+            myfile.write(text)
+        os.replace(temp_file, asset_file)
+    return digest
+
+
+def load_asset(assets_dir, digest):
+    """assets are immutable, so each one is read and verified once per process and then shared by all templates"""
+    asset = _assets.get(digest)
+    if asset is not None:
+        return asset
+    with _assets_lock:
+        if digest not in _assets:
+            with open(get_asset_file(assets_dir, digest), 'r', encoding='utf-8') as myfile:
+                text = myfile.read()
+            if get_asset_digest(text) != digest:
+                raise ValueError('asset does not match its digest: ' + get_asset_file(assets_dir, digest))
+            _assets[digest] = Asset(text)
+        return _assets[digest]
+
+
+class AssetRef(object):
+    """$[asset <sha256>], replaced by the asset's text when rendering"""
+
+    def __init__(self, digest, assets_dir):
+        self.digest = digest
+        self.assets_dir = assets_dir
+
+    def iter_parts(self, mapping):
+        return (load_asset(self.assets_dir, self.digest),)
+
+    def to_dict(self):
+        return {'asset': self.digest}
+
+
+def iter_slot(slot, mapping):
+    if isinstance(slot, str):
+        return (str(mapping[slot]),)
+    return slot.iter_parts(mapping)
+
+
+def slot_from_dict(slot, assets_dir):
+    if isinstance(slot, str):
+        return slot
+    if 'asset' in slot:
+        return AssetRef(slot['asset'], assets_dir)
+    if 'repeat' in slot:
+        return RepeatBlock(slot['repeat'], slot['separator'], CompiledTemplate.from_dict(slot['body'], assets_dir))
+    return ReduceBlock(slot['reduce'], CompiledTemplate.from_dict(slot['leaf'], assets_dir),
+                       CompiledTemplate.from_dict(slot['node'], assets_dir))
+
+
+class CompiledTemplate(object):
+    """a template split into literal segments and slots: segments[0] slot[0] segments[1] ... segments[n]
+
+    a slot is a placeholder name or a repeat/reduce block; rendering follows string.Template.substitute()
+    semantics ($$ escapes, KeyError for missing values)
+    """
+
+    def __init__(self, segments, slots, source_hash=None):
+        if len(segments) != len(slots) + 1:
+            raise ValueError('expected one more literal segment than slots')
+        self.segments = segments
+        self.slots = slots
+        self.source_hash = source_hash
+        self.has_blocks = any(not isinstance(slot, str) for slot in slots)
+
+    def render(self, mapping):
+        if not self.has_blocks:
+            parts = [None] * (len(self.segments) + len(self.slots))
+            parts[0::2] = self.segments
+            parts[1::2] = [str(mapping[name]) for name in self.slots]
+            return ''.join(parts)
+        return ''.join(self.iter_parts(mapping))
+
+    def iter_parts(self, mapping):
+        for segment, slot in zip(self.segments, self.slots):
+            yield segment
+            yield from iter_slot(slot, mapping)
+        yield self.segments[-1]
+
+    def render_chunks(self, mapping, chunk_size=RENDER_CHUNK_SIZE):
+        """renders the template as utf-8 encoded chunks of about chunk_size bytes, without building the whole string"""
+        buffered = []
+        buffered_size = 0
+        for part in self.iter_parts(mapping):
+            if type(part) is Asset:
+                if buffered:
+                    yield ''.join(buffered).encode('utf-8')
+                    buffered = []
+                    buffered_size = 0
+                yield part.encoded
+                continue
+            buffered.append(part)
+            buffered_size += len(part)
+            if buffered_size >= chunk_size:
+                yield ''.join(buffered).encode('utf-8')
+                buffered = []
+                buffered_size = 0
+        if buffered:
+            yield ''.join(buffered).encode('utf-8')
+
+    def to_dict(self):
+        compiled = {
+            'segments': self.segments,
+            'slots': [slot if isinstance(slot, str) else slot.to_dict() for slot in self.slots]
+        }
+        if self.source_hash is not None:
+            compiled['version'] = COMPILED_TEMPLATE_VERSION
+            compiled['source_hash'] = self.source_hash
+        return compiled
+
+    @classmethod
+    def from_dict(cls, compiled, assets_dir=None):
+        if 'source_hash' in compiled and compiled.get('version') != COMPILED_TEMPLATE_VERSION:
+            raise ValueError('unsupported compiled template version: ' + str(compiled.get('version')))
+        return cls(compiled['segments'], [slot_from_dict(slot, assets_dir) for slot in compiled['slots']],
+                   compiled.get('source_hash'))
+
+
+def get_source_hash(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def get_location(source, position):
+    lines = source[:position].splitlines(keepends=True)
+    if not lines:
+        return 'line 1, col 1'
+    return 'line ' + str(len(lines)) + ', col ' + str(len(lines[-1]))
+
+
+class TemplateBuilder(object):
+
+    def __init__(self):
+        self.segments = []
+        self.slots = []
+        self.literal = []
+
+    def add_literal(self, text):
+        self.literal.append(text)
+
+    def add_slot(self, slot):
+        self.segments.append(''.join(self.literal))
+        self.slots.append(slot)
+        self.literal = []
+
+    def add_placeholders(self, source, start, end):
+        position = start
+        for match in Template.pattern.finditer(source, start, end):
+            self.add_literal(source[position:match.start()])
+            position = match.end()
+            if match.group('escaped') is not None:
+                self.add_literal(Template.delimiter)
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError('Invalid placeholder in string: ' + get_location(source, match.start('invalid')))
+            self.add_slot(name)
+        self.add_literal(source[position:end])
+
+    def build(self, source_hash=None):
+        return CompiledTemplate(self.segments + [''.join(self.literal)], self.slots, source_hash)
+
+
+def parse_directive_args(args):
+    parsed = {}
+    for match in DIRECTIVE_ARG_PATTERN.finditer(args):
+        value = match.group(2)
+        parsed[match.group(1)] = value.encode('utf-8').decode('unicode_escape') if value is not None else None
+    return parsed
+
+
+def compile_template(source, assets_dir=None):
+    """compiles ${NAME} placeholders, $[asset <sha256>] references to the assets in assets_dir and the block directives
+
+        $[repeat <service> separator="<text>"]<body>$[/repeat]
+        $[reduce <service>]<leaf>$[node]<node with ${LEFT} and ${RIGHT}>$[/reduce]
+    """
+    # each stack entry: (directive, args, builder, start of directive); builders collect the body of the open block
+    stack = [(None, None, TemplateBuilder(), 0)]
+    position = 0
+    for match in DIRECTIVE_PATTERN.finditer(source):
+        directive = match.group('directive')
+        builder = stack[-1][2]
+        builder.add_placeholders(source, position, match.start())
+        position = match.end()
+        if directive == 'asset':
+            args = parse_directive_args(match.group('args'))
+            if len(args) != 1 or list(args.values())[0] is not None:
+                raise ValueError('expected the sha256 of the asset in $[asset] at ' + get_location(source, match.start()))
+            builder.add_slot(AssetRef(list(args)[0], assets_dir))
+        elif directive in ('repeat', 'reduce'):
+            args = parse_directive_args(match.group('args'))
+            services = [name for name, value in args.items() if value is None]
+            if len(services) != 1:
+                raise ValueError('expected one service name in $[' + directive + '] at ' +
+                                 get_location(source, match.start()))
+            args['service'] = services[0]
+            stack.append((directive, args, TemplateBuilder(), match.start()))
+        elif directive == 'node' and stack[-1][0] == 'reduce' and 'leaf' not in stack[-1][1]:
+            stack[-1][1]['leaf'] = builder.build()
+            stack[-1] = stack[-1][:2] + (TemplateBuilder(), stack[-1][3])
+        elif directive == '/repeat' and stack[-1][0] == 'repeat':
+            args = stack.pop()[1]
+            stack[-1][2].add_slot(RepeatBlock(args['service'], args.get('separator') or '', builder.build()))
+        elif directive == '/reduce' and stack[-1][0] == 'reduce' and 'leaf' in stack[-1][1]:
+            args = stack.pop()[1]
+            stack[-1][2].add_slot(ReduceBlock(args['service'], args['leaf'], builder.build()))
+        else:
+            raise ValueError('unexpected $[' + directive + '] at ' + get_location(source, match.start()))
+    if len(stack) > 1:
+        raise ValueError('unclosed $[' + stack[-1][0] + '] at ' + get_location(source, stack[-1][3]))
+    builder = stack[0][2]
+    builder.add_placeholders(source, position, len(source))
+    return builder.build(get_source_hash(source))
+
+
+def get_compiled_file(template_file):
+    return template_file + COMPILED_TEMPLATE_SUFFIX
+
+
+def get_assets_dir(template_file):
+    return os.path.join(os.path.dirname(template_file), ASSETS_DIR)
+
+
+def write_compiled_template(template_file):
+    with open(template_file, 'r', encoding='utf-8') as myfile:
+        compiled = compile_template(myfile.read(), get_assets_dir(template_file))
+    compiled_file = get_compiled_file(template_file)
+    with open(compiled_file, 'w', encoding='utf-8') as myfile:
+        json.dump(compiled.to_dict(), myfile, separators=(',', ':'))
+    return compiled_file
+
+
+def read_compiled_template(template_file, source_hash):
+    """returns the build-time compiled template if it was compiled from the current source, otherwise None"""
+    compiled_file = get_compiled_file(template_file)
+    if not os.path.exists(compiled_file):
+        return None
+    try:
+        with open(compiled_file, 'r', encoding='utf-8') as myfile:
+            compiled = CompiledTemplate.from_dict(json.load(myfile), get_assets_dir(template_file))
+    except (ValueError, KeyError) as e:
+        logger.warning('ignoring unreadable compiled template ' + compiled_file + ': ' + str(e))
+        return None
+    if compiled.source_hash != source_hash:
+        logger.debug('compiled template ' + compiled_file + ' is stale')
+        return None
+    return compiled
+
+
+class TemplateRegistry(object):
+    """loads and compiles each template once; entries are revalidated by file mtime/size and then content hash"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_file):
+        stat = os.stat(template_file)
+        file_version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(template_file)
+            if entry is not None and entry[0] == file_version:
+                return entry[1]
+            with open(template_file, 'r', encoding='utf-8') as myfile:
+                source = myfile.read()
+            source_hash = get_source_hash(source)
+            if entry is not None and entry[1].source_hash == source_hash:
+                compiled = entry[1]
+            else:
+                compiled = read_compiled_template(template_file, source_hash)
+                if compiled is None:
+                    logger.debug('compiling template: ' + template_file)
+                    compiled = compile_template(source, get_assets_dir(template_file))
+                else:
+                    logger.debug('loaded compiled template: ' + get_compiled_file(template_file))
+            self._entries[template_file] = (file_version, compiled)
+            return compiled
+
+    def render(self, template_file, mapping):
+        return self.get(template_file).render(mapping)
+
+    def render_chunks(self, template_file, mapping, chunk_size=RENDER_CHUNK_SIZE):
+        return self.get(template_file).render_chunks(mapping, chunk_size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+template_registry = TemplateRegistry()
+
+
+def run():
+    for template_file in sys.argv[1:]:
+        print('wrote compiled template to: ' + write_compiled_template(template_file))
+
+
+if __name__ == '__main__':
+    run()
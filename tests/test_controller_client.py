@@ -0,0 +1,80 @@
+import os
+import sys
+import io
+import gzip
+import unittest
+from unittest import mock
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from controller_client import ControllerClient
+
+FILE_CHUNKS = [b'<health-rules>', b'<health-rule/>', b'</health-rules>']
+
+
+class FakeController(object):
+    """answers the uploads sent through a client's session with the given statuses, recording each request's body"""
+
+    def __init__(self, *status_codes):
+        self.status_codes = list(status_codes)
+        self.uploads = []
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        body = b''.join(data)
+        if headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.uploads.append((headers.get('Content-Encoding'), body))
+        response = requests.Response()
+        response.status_code = self.status_codes.pop(0)
+        response.raw = io.BytesIO()
+        response.request = requests.Request(method, url, data=body).prepare()
+        return response
+
+
+class PostFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ControllerClient('http://controller:8090', 'user@customer1', 'secret')
+
+    def tearDown(self):
+        self.client.close()
+
+    def post_file(self, controller):
+        with mock.patch.object(self.client.session, 'request', controller.request):
+            return self.client.post_file('/controller/healthrules/app', lambda: iter(FILE_CHUNKS), compress=True)
+
+    def assertUploads(self, controller, encodings):
+        self.assertEqual([encoding for encoding, body in controller.uploads], encodings)
+        for encoding, body in controller.uploads:
+            self.assertIn(b''.join(FILE_CHUNKS), body)
+
+    def test_accepted_gzip_upload_is_kept_compressed(self):
+        controller = FakeController(200, 200)
+        self.assertEqual(self.post_file(controller).status_code, 200)
+        self.assertEqual(self.post_file(controller).status_code, 200)
+        self.assertTrue(self.client.gzip_accepted)
+        self.assertUploads(controller, ['gzip', 'gzip'])
+
+    def test_any_failed_first_gzip_upload_is_repeated_uncompressed(self):
+        for status_code in (400, 413, 415, 500):
+            with self.subTest(status_code=status_code):
+                self.client.gzip_accepted = None
+                controller = FakeController(status_code, 200, 200)
+                self.assertEqual(self.post_file(controller).status_code, 200)
+                self.assertIs(self.client.gzip_accepted, False)
+                self.assertEqual(self.post_file(controller).status_code, 200)
+                self.assertUploads(controller, ['gzip', None, None])
+
+    def test_failure_after_accepted_gzip_upload_is_returned(self):
+        controller = FakeController(200, 500)
+        self.post_file(controller)
+        self.assertEqual(self.post_file(controller).status_code, 500)
+        self.assertTrue(self.client.gzip_accepted)
+        self.assertUploads(controller, ['gzip', 'gzip'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import pcf_dash_generator
+from pcf_dash_generator import AppConfig, TargetConfig
+
+TIER_NAME = 'foundation-01'
+PARENT_FOLDER = 'cf-b9d6aaa85e4cb19f2c92'
+
+
+class FakeResponse(object):
+
+    def __init__(self, folders):
+        self.folders = folders
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.folders
+
+
+class FakeMetricBrowser(object):
+    """serves the metric browser listings of a foundation with a single diego cell, counting the listings by path"""
+
+    def __init__(self, metric_path_root):
+        self.metric_path_root = metric_path_root
+        self.listings = {
+            metric_path_root: [{'name': PARENT_FOLDER}],
+            metric_path_root + '|' + PARENT_FOLDER: [{'name': 'diego_cell'}],
+            metric_path_root + '|' + PARENT_FOLDER + '|diego_cell': [{'name': 'diego_cell-0000'}]
+        }
+        self.requests = []
+
+    def get(self, path, params=None):
+        self.requests.append(params['metric-path'])
+        return FakeResponse(self.listings.get(params['metric-path'], []))
+
+    def get_root_listings(self):
+        return self.requests.count(self.metric_path_root)
+
+
+class MetricCacheRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (AppConfig.state_dir, AppConfig.metric_cache_ttl, AppConfig.snapshot_dir)
+        AppConfig.state_dir = tempfile.mkdtemp()
+        AppConfig.metric_cache_ttl = 3600
+        AppConfig.snapshot_dir = None
+        self.target = TargetConfig('http://127.0.0.1:8090', 'customer1', 'user', 'pass', 'PCF', TIER_NAME, '118')
+        self.browser = FakeMetricBrowser(pcf_dash_generator.get_system_metrics_root_path(self.target))
+        patcher = mock.patch.object(self.target, 'get_client', return_value=self.browser)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(AppConfig.state_dir)
+        AppConfig.state_dir, AppConfig.metric_cache_ttl, AppConfig.snapshot_dir = self.saved
+
+    def discover(self, refresh):
+        del self.browser.requests[:]
+        return pcf_dash_generator.discover_target(self.target, False, None, refresh=refresh)
+
+    def test_cached_run_does_not_list_the_metric_tree(self):
+        expected = (PARENT_FOLDER, {'diego_cell': [{'guid': 'diego_cell-0000'}]})
+        self.assertEqual(self.discover(refresh=False), expected)
+        self.assertEqual(self.discover(refresh=False), expected)
+        self.assertEqual(self.browser.requests, [])
+
+    def test_forced_run_lists_the_root_again(self):
+        self.discover(refresh=False)
+        self.discover(refresh=True)
+        # once by the metric path check, and once more to find the parent folder
+        self.assertEqual(self.browser.get_root_listings(), 2)
+
+    def test_forced_metric_path_check_lists_the_root_again(self):
+        self.discover(refresh=False)
+        del self.browser.requests[:]
+        pcf_dash_generator.check_pcf_metric_path_exists(self.target)
+        self.assertEqual(self.browser.get_root_listings(), 0)
+        pcf_dash_generator.check_pcf_metric_path_exists(self.target, refresh=True)
+        self.assertEqual(self.browser.get_root_listings(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
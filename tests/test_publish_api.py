@@ -0,0 +1,39 @@
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import pcf_dash_generator
+from pcf_dash_generator import AppConfig, TargetConfig
+
+
+def get_target(name):
+    return TargetConfig('http://127.0.0.1:8090', 'customer1', 'user', 'pass', 'PCF', name, '118', name=name)
+
+
+class PublishApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (AppConfig.targets, AppConfig.configured)
+        AppConfig.targets = [get_target('foundation-01'), get_target('foundation-02')]
+        AppConfig.configured = True
+        self.client = pcf_dash_generator.create_app().test_client()
+
+    def tearDown(self):
+        AppConfig.targets, AppConfig.configured = self.saved
+
+    def test_unknown_target_is_rejected_with_message(self):
+        response = self.client.post('/pcf-dash/publish?target=foo')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_data(as_text=True), 'unknown target: foo')
+
+    def test_missing_target_is_rejected_with_message(self):
+        response = self.client.post('/pcf-dash/publish')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_data(as_text=True), 'target name is required when 2 targets are configured')
+
+
+if __name__ == '__main__':
+    unittest.main()
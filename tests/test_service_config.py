@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import signal
+import unittest
+import multiprocessing
+from unittest import mock
+from types import SimpleNamespace
+from multiprocessing.connection import wait
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import service_config
+from service_config import Publisher
+
+
+def ignore_sigterm():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(60)
+
+
+class PublisherTest(unittest.TestCase):
+
+    def start(self, target, args=()):
+        publisher = Publisher(target, args)
+        publisher.start()
+        self.addCleanup(self.reap, publisher)
+        return publisher
+
+    def reap(self, publisher):
+        # done by the gunicorn master when the publisher runs under it
+        try:
+            os.kill(publisher.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(publisher.pid, 0)
+        os.close(publisher.sentinel)
+
+    def test_publisher_is_not_a_multiprocessing_child(self):
+        # the workers forked after it must not inherit it as a child they would join or terminate on exit
+        publisher = self.start(time.sleep, (60,))
+        self.assertEqual(multiprocessing.active_children(), [])
+        self.assertFalse(wait([publisher.sentinel], 0))
+
+    def test_sentinel_is_ready_once_publisher_exits(self):
+        publisher = self.start(time.sleep, (0,))
+        self.assertTrue(wait([publisher.sentinel], 10))
+
+    def test_on_exit_terminates_publisher(self):
+        publisher = self.start(time.sleep, (60,))
+        server = SimpleNamespace(publisher=publisher, log=mock.Mock(), cfg=SimpleNamespace(graceful_timeout=10))
+        service_config.on_exit(server)
+        self.assertTrue(wait([publisher.sentinel], 0))
+        server.log.warning.assert_not_called()
+
+    def test_on_exit_kills_publisher_that_does_not_stop(self):
+        publisher = self.start(ignore_sigterm)
+        time.sleep(0.2)
+        server = SimpleNamespace(publisher=publisher, log=mock.Mock(), cfg=SimpleNamespace(graceful_timeout=0.5))
+        service_config.on_exit(server)
+        self.assertTrue(wait([publisher.sentinel], 10))
+        server.log.warning.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import json
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from pcf_dash_generator import AppConfig, TargetConfig
+
+
+class TargetOverridesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.default = TargetConfig('http://controller:8090', 'customer1', 'user', 'pass', 'PCF', 'foundation-01',
+                                    '118')
+
+    def test_numeric_controller_port(self):
+        targets = AppConfig.load_targets(self.default, targets_json=json.dumps([
+            {'name': 'numeric', 'controller_host': 'other-controller', 'controller_port': 8090},
+            {'name': 'string', 'controller_host': 'other-controller', 'controller_port': '8090'}
+        ]))
+        self.assertEqual([target.controller_url for target in targets],
+                         ['http://other-controller:8090', 'http://other-controller:8090'])
+
+    def test_controller_host_without_port(self):
+        target = self.default.with_overrides({'controller_host': 'other-controller', 'controller_ssl_enabled': True})
+        self.assertEqual(target.controller_url, 'https://other-controller')
+
+    def test_overrides_keep_other_settings(self):
+        target = self.default.with_overrides({'tier': 'foundation-02', 'tier_id': '119'})
+        self.assertEqual((target.controller_url, target.app, target.tier, target.tier_id, target.name),
+                         ('http://controller:8090', 'PCF', 'foundation-02', '119', 'PCF-foundation-02'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import re
+import sys
+import json
+import unittest
+from string import Template
+from xml.etree import ElementTree
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import pcf_dash_generator
+from template_registry import compile_template, TemplateRegistry
+
+DIEGO_CELL_COUNTS = [1, 2, 3, 10, 50, 100, 300]
+# instance counts of the other services, rendered along with each number of diego cells
+SERVICE_INSTANCE_COUNTS = [1, 2, 3]
+
+# a per-instance key such as ${ROUTER_0_GUID}, or a literal instance guid
+INSTANCE_REFERENCE_PATTERN = re.compile(r'\$\{[A-Z_]+_\d+_GUID\}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+DIRECTIVE_FREE_SOURCES = [
+    '',
+    'no placeholders at all',
+    '${TIER_NAME}',
+    'Server|Component:${TIER_ID}|Custom Metrics|$TIER_NAME|${TIER_NAME}x',
+    '$${escaped} $$TIER_NAME $$ and ${TIER_ID}${TIER_ID}',
+    '{"name": "${TIER_NAME}-é中", "cost": "$$5"}',
+    '<metric-name>${DIEGO_CELL_0_GUID}|$DIEGO_CELL_1_GUID</metric-name>\n'
+]
+
+MAPPING = {
+    'TIER_NAME': 'foundation-01',
+    'TIER_ID': 118,
+    'DIEGO_CELL_0_GUID': 'cell-0',
+    'DIEGO_CELL_1_GUID': 'cell-1'
+}
+
+
+def get_pcf_services(diego_cells, instances=1):
+    return {service_name: [{'guid': '%s-%04d' % (service_name, i)}
+                           for i in range(diego_cells if service_name == 'diego_cell' else instances)]
+            for service_name in pcf_dash_generator.PCF_SERVICE_NAMES}
+
+
+def get_template_keyvalues(diego_cells, instances=1):
+    return pcf_dash_generator.get_template_keyvalues(get_pcf_services(diego_cells, instances),
+                                                     'cf-b9d6aaa85e4cb19f2c92', 'PCF', 'foundation-01', '118')
+
+
+def get_instance_counts():
+    for diego_cells in DIEGO_CELL_COUNTS:
+        for instances in SERVICE_INSTANCE_COUNTS:
+            yield diego_cells, instances
+
+
+class DirectiveFreeRenderTest(unittest.TestCase):
+    """templates without block directives render exactly like string.Template.substitute()"""
+
+    def test_render_matches_string_template(self):
+        for source in DIRECTIVE_FREE_SOURCES:
+            with self.subTest(source=source):
+                compiled = compile_template(source)
+                expected = Template(source).substitute(MAPPING)
+                self.assertEqual(compiled.render(MAPPING), expected)
+                self.assertEqual(b''.join(compiled.render_chunks(MAPPING, chunk_size=4)), expected.encode('utf-8'))
+
+    def test_missing_value_raises_key_error(self):
+        with self.assertRaises(KeyError):
+            Template('${UNKNOWN}').substitute(MAPPING)
+        with self.assertRaises(KeyError):
+            compile_template('${UNKNOWN}').render(MAPPING)
+
+    def test_invalid_placeholder_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            Template('cost: $5').substitute(MAPPING)
+        with self.assertRaises(ValueError):
+            compile_template('cost: $5')
+
+
+class PcfTemplatesRenderTest(unittest.TestCase):
+    """the shipped templates render as valid json/xml for foundations of any number of diego cells"""
+
+    def setUp(self):
+        self.registry = TemplateRegistry()
+
+    def render(self, template_file, keyvalues):
+        rendered = self.registry.render(os.path.join(REPO_DIR, template_file), keyvalues)
+        chunks = self.registry.render_chunks(os.path.join(REPO_DIR, template_file), keyvalues)
+        self.assertEqual(b''.join(chunks), rendered.encode('utf-8'))
+        return rendered
+
+    def assertRendersInstances(self, rendered, service_name, count):
+        """the metric paths of exactly the first count instances of the service are rendered"""
+        for i in range(count + 1):
+            metric_path = '|%s|%s-%04d|' % (service_name, service_name, i)
+            self.assertEqual(metric_path in rendered, i < count, metric_path)
+
+    def test_healthrules_render_as_xml(self):
+        for diego_cells, instances in get_instance_counts():
+            with self.subTest(diego_cells=diego_cells, instances=instances):
+                keyvalues = get_template_keyvalues(diego_cells, instances)
+                root = ElementTree.fromstring(self.render(pcf_dash_generator.pcf_hrs_template_file, keyvalues))
+                self.assertEqual(root.tag, 'health-rules')
+                self.assertTrue(root.findall('health-rule'))
+                rendered = ElementTree.tostring(root, encoding='unicode')
+                self.assertRendersInstances(rendered, 'diego_cell', diego_cells)
+                for service_name in ['router', 'nats', 'tcp_router', 'mysql_proxy', 'credhub', 'diego_brain']:
+                    self.assertRendersInstances(rendered, service_name, instances)
+
+    def test_dashboard_renders_as_json(self):
+        for diego_cells, instances in get_instance_counts():
+            with self.subTest(diego_cells=diego_cells, instances=instances):
+                rendered = self.render(pcf_dash_generator.pcf_dash_template_file,
+                                       get_template_keyvalues(diego_cells, instances))
+                dashboard = json.loads(rendered)
+                self.assertEqual(dashboard['name'], 'PCF-foundation-01-PCF KPI Dashboard')
+                self.assertRendersInstances(rendered, 'diego_cell', diego_cells)
+                self.assertRendersInstances(rendered, 'router', instances)
+                self.assertRendersInstances(rendered, 'uaa', instances)
+
+    def test_templates_refer_to_instances_only_through_blocks(self):
+        for template_file in [pcf_dash_generator.pcf_hrs_template_file, pcf_dash_generator.pcf_dash_template_file]:
+            with self.subTest(template_file=template_file):
+                with open(os.path.join(REPO_DIR, template_file), 'r', encoding='utf-8') as myfile:
+                    self.assertEqual(INSTANCE_REFERENCE_PATTERN.findall(myfile.read()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
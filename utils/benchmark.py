@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""benchmarks publish_dashboard_and_hrs() against the local stub controller for simulated foundations of given sizes"""
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import resource
+import tempfile
+import traceback
+import tracemalloc
+import multiprocessing
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS_DIR = os.path.join(REPO_DIR, 'utils')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--diego_cells', help='comma separated list of diego_cell counts to benchmark', default='3,300')
+    parser.add_argument('--instances', help='number of instances of every other pcf service', type=int, default=1)
+    parser.add_argument('--latency_ms', help='latency added by the stub controller to every request',
+                        type=float, default=20)
+    parser.add_argument('--hr_save_delay', help='seconds before uploaded health rules show up in the export',
+                        type=float, default=0)
+    parser.add_argument('--runs', help='number of publishes per foundation size', type=int, default=3)
+    parser.add_argument('--gzip_uploads', help='gzip the uploads to the stub controller', action='store_true',
+                        default=False)
+    parser.add_argument('--trace_memory', help='also report the peak python heap of each publish (slower)',
+                        action='store_true', default=False)
+    parser.add_argument('--json', help='print results as json', action='store_true', default=False)
+    args = parser.parse_args()
+    return args
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_stub(port, diego_cells, instances, latency, hr_save_delay):
+    sys.path.insert(0, UTILS_DIR)
+    import stub_controller
+    ready = multiprocessing.Event()
+    stub = multiprocessing.Process(target=stub_controller.serve,
+                                   args=(port, diego_cells, instances, latency, hr_save_delay, ready, True), daemon=True)
+    stub.start()
+    if not ready.wait(10):
+        raise RuntimeError('stub controller failed to start')
+    return stub
+
+
+def import_generator(port, state_dir, gzip_uploads=False):
+    """pcf_dash_generator reads its configuration from the environment and its templates relative to the cwd"""
+    os.chdir(REPO_DIR)
+    os.environ.update({
+        'APPD_MA_HOST_NAME': '127.0.0.1',
+        'APPD_MA_PORT': str(port),
+        'APPD_MA_ACCOUNT_NAME': 'customer1',
+        'APPD_MA_USER_NAME': 'benchmark',
+        'APPD_MA_USER_PASS': 'benchmark',
+        'APPD_NOZZLE_APP_NAME': 'PCF',
+        'APPD_NOZZLE_TIER_NAME': 'foundation-01',
+        'APPD_NOZZLE_TIER_ID': '118',
+        'APPD_MA_STATE_DIR': state_dir,
+        'APPD_MA_GZIP_UPLOADS': 'true' if gzip_uploads else 'false'
+    })
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    import pcf_dash_generator
+    pcf_dash_generator.start_app_pcf()
+    logging.getLogger().setLevel(logging.WARNING)
+    return pcf_dash_generator
+
+
+def get_stub_stats(generator, reset=False):
+    client = generator.AppConfig.get_target().get_client()
+    response = client.session.request('DELETE' if reset else 'GET', client.url('/stub/stats'))
+    response.raise_for_status()
+    return response.json()
+
+
+def get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def benchmark_publish(generator, force, trace_memory=False):
+    phases = []
+
+    def progress(phase):
+        phases.append((phase, time.perf_counter()))
+
+    get_stub_stats(generator, reset=True)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    published = generator.publish_dashboard_and_hrs(retry=False, recreate_dashboard=force, overwrite_hrs=force,
+                                                    force=force, progress=progress)
+    end = time.perf_counter()
+    peak_heap = None
+    if trace_memory:
+        peak_heap = round(tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0, 1)
+        tracemalloc.stop()
+    stats = get_stub_stats(generator)
+    phase_times = {}
+    for i, (phase, phase_start) in enumerate(phases):
+        phase_end = phases[i + 1][1] if i + 1 < len(phases) else end
+        phase_times[phase] = round(phase_end - phase_start, 4)
+    return {
+        'published': published,
+        'wall_seconds': round(end - start, 4),
+        'phase_seconds': phase_times,
+        'http_requests': stats['requests'],
+        'http_requests_by_endpoint': stats['requests_by_endpoint'],
+        'bytes_uploaded': stats['bytes_uploaded'],
+        'bytes_downloaded': stats['bytes_sent'],
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+        'peak_heap_mb': peak_heap
+    }
+
+
+def benchmark_foundation(diego_cells, args):
+    """runs in its own process so that peak rss and module state are per foundation size"""
+    port = get_free_port()
+    stub = start_stub(port, diego_cells, args.instances, args.latency_ms / 1000.0, args.hr_save_delay)
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            generator = import_generator(port, state_dir, args.gzip_uploads)
+            results = [benchmark_publish(generator, True, args.trace_memory) for i in range(args.runs)]
+            results.append(benchmark_publish(generator, False, args.trace_memory))
+    finally:
+        stub.terminate()
+    return results
+
+
+def run_in_process(diego_cells, args, results):
+    """puts the results, or the traceback of the failed benchmark, on the results queue"""
+    try:
+        results.put(benchmark_foundation(diego_cells, args))
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+
+def get_process_results(process, results):
+    """waits for the results of the benchmark process, or for it to exit without any (e.g. if it was killed)"""
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                return {'error': 'benchmark process exited with code ' + str(process.exitcode) + ' without results'}
+
+
+def print_results(diego_cells, results):
+    print('diego_cells=' + str(diego_cells))
+    for i, result in enumerate(results):
+        label = 'unchanged refresh' if i == len(results) - 1 else 'publish #' + str(i + 1)
+        print('  %-18s wall=%7.3fs requests=%4d uploaded=%9d bytes downloaded=%9d bytes peak_rss=%6.1f MB' %
+              (label, result['wall_seconds'], result['http_requests'], result['bytes_uploaded'],
+               result['bytes_downloaded'], result['peak_rss_mb']) +
+              ('' if result['peak_heap_mb'] is None else ' peak_heap=%6.1f MB' % result['peak_heap_mb']))
+        print('  %-18s ' % '' + ', '.join(phase + '=' + str(seconds) + 's'
+                                         for phase, seconds in result['phase_seconds'].items()))
+
+
+def run():
+    args = parse_args()
+    all_results = {}
+    failed = False
+    for diego_cells in [int(count) for count in args.diego_cells.split(',')]:
+        results_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_in_process, args=(diego_cells, args, results_queue))
+        process.start()
+        results = get_process_results(process, results_queue)
+        process.join()
+        all_results[diego_cells] = results
+        if 'error' in results:
+            failed = True
+            print('diego_cells=' + str(diego_cells) + ' failed:\n' + results['error'], file=sys.stderr)
+        elif not args.json:
+            print_results(diego_cells, results)
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,34 +1,131 @@
 #!/usr/bin/env python3
+import os
+import re
+import sys
 import argparse
 import json
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# json string values holding data uris, e.g. the imageURL of ImageWidgets
+DATA_URI_PATTERN = re.compile(r'"(data:[^"\\]*)"')
+# files templatized in batch mode: dashboard (.json) and health rule (.xml) exports
+BATCH_SUFFIXES = ('.json', '.xml')
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--source_file", help='file to create template from', required=True)
-    parser.add_argument("--template_mappings", help='json file with strings to replace', required=True)    
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument("--source_file", help='file to create template from')
+    sources.add_argument("--source_dir", help='batch mode: create templates from all .json and .xml files in this '
+                                              'directory', default=None)
+    parser.add_argument("--output_dir", help='batch mode: directory to write the templates to, defaults to the '
+                                             'source_dir with .output files', default=None)
+    parser.add_argument("--template_mappings", help='json file with strings to replace', default=None)
+    parser.add_argument("--hrs_template_mappings", help='batch mode: json file with strings to replace in the .xml '
+                                                        'health rule files, defaults to --template_mappings',
+                        default=None)
+    parser.add_argument("--assets_dir", help='move data uris (e.g. images) into this content addressed asset store, '
+                                             'normally templates/assets', default=None)
+    parser.add_argument("--max_workers", help='batch mode: number of worker processes, defaults to the cpu count',
+                        type=int, default=None)
     args = parser.parse_args()
     print(args)
     return args
 
-    
-def create_template(source_file, template_mappings):
+
+def load_template_mappings(template_mappings_file):
+    if not template_mappings_file:
+        return []
+    with open(template_mappings_file, 'r', encoding='utf-8') as myfile:
+        return json.load(myfile)
+
+
+@lru_cache(maxsize=None)
+def get_mappings_pattern(template_mappings):
+    """compiles the mappings into one alternation, longest string first, so that every position of the source is
+    replaced by the longest string matching there regardless of the order of the mappings; the first mapping of a
+    string wins"""
+    replacements = {}
+    for original, replacement in template_mappings:
+        if original:
+            replacements.setdefault(original, replacement)
+    if not replacements:
+        return None, replacements
+    alternatives = sorted(replacements, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(original) for original in alternatives)), replacements
+
+
+def apply_template_mappings(source, template_mappings):
+    """replaces all mapped strings in a single pass over the source"""
+    pattern, replacements = get_mappings_pattern(tuple(tuple(mapping) for mapping in template_mappings))
+    if pattern is None:
+        return source
+    return pattern.sub(lambda match: replacements[match.group(0)], source)
+
+
+def extract_assets(source, assets_dir):
+    sys.path.insert(0, REPO_DIR)
+    from template_registry import write_asset
+    digests = set()
+
+    def to_asset_ref(match):
+        digest = write_asset(assets_dir, match.group(1))
+        digests.add(digest)
+        return '"$[asset ' + digest + ']"'
+
+    source, count = DATA_URI_PATTERN.subn(to_asset_ref, source)
+    print('moved ' + str(count) + ' data uris to ' + str(len(digests)) + ' assets in: ' + assets_dir)
+    return source
+
+
+def create_template(source_file, template_mappings, assets_dir=None, output_file=None):
     with open(source_file, 'r', encoding='utf-8') as myfile:
         source=myfile.read()
 
-    for mapping in template_mappings:
-        source = source.replace(mapping[0], mapping[1])
+    source = apply_template_mappings(source, template_mappings)
+
+    if assets_dir:
+        source = extract_assets(source, assets_dir)
 
-    with open(source_file + '.output', 'w', encoding='utf-8') as myfile:
+    output_file = output_file or source_file + '.output'
+    with open(output_file, 'w', encoding='utf-8') as myfile:
         myfile.write(source)
 
-    print("wrote output to: " + source_file + '.output')
-    
+    print("wrote output to: " + output_file)
+    return output_file
+
+
+def create_templates(source_dir, output_dir, template_mappings, hrs_template_mappings, assets_dir=None,
+                     max_workers=None):
+    """creates templates from all dashboard and health rule exports in source_dir in parallel worker processes"""
+    source_files = sorted(file_name for file_name in os.listdir(source_dir) if file_name.endswith(BATCH_SUFFIXES))
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for file_name in source_files:
+            mappings = hrs_template_mappings if file_name.endswith('.xml') else template_mappings
+            output_file = os.path.join(output_dir, file_name) if output_dir else None
+            futures.append(executor.submit(create_template, os.path.join(source_dir, file_name), mappings,
+                                           assets_dir, output_file))
+        output_files = [future.result() for future in futures]
+    print('created ' + str(len(output_files)) + ' templates from: ' + source_dir)
+    return output_files
+
+
 def run():
     args = parse_args()
-    with open(args.template_mappings, 'r', encoding='utf-8') as myfile:
-        template_mappings=json.load(myfile)
-    
-    create_template(args.source_file, template_mappings)
-    
+    template_mappings = load_template_mappings(args.template_mappings)
+
+    if args.source_dir:
+        hrs_template_mappings = load_template_mappings(args.hrs_template_mappings) if args.hrs_template_mappings \
+            else template_mappings
+        create_templates(args.source_dir, args.output_dir, template_mappings, hrs_template_mappings, args.assets_dir,
+                         args.max_workers)
+        return
+
+    create_template(args.source_file, template_mappings, args.assets_dir)
+
 if __name__ == '__main__':
     run()
@@ -1,7 +1,22 @@
 #!/usr/bin/env python3
-import requests
-import xml.dom.minidom
+"""exports the health rules of one, several or all applications of a controller, one rule at a time, to per-app xml
+files or a single zip archive, each with an index.json listing the exported apps and rules"""
+import os
+import re
+import sys
+import json
+import shutil
+import zipfile
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDENT = '   '
+INDEX_FILE = 'index.json'
+EXPORT_MAX_WORKERS = 8
 
 def get_controller_url(host, port, ssl_enabled):
     if ssl_enabled is True:
@@ -21,29 +36,152 @@ def parse_args():
     parser.add_argument('--account_name', help='the controller account name', required=True, default='customer1')
     parser.add_argument('--user_name', help='the controller username', required=True)
     parser.add_argument('--user_pass', help='the controller user password', required=True)
-    parser.add_argument('--app', help='the Appd app to export health rules from', required=True)
+    apps = parser.add_mutually_exclusive_group(required=True)
+    apps.add_argument('--app', help='the Appd app to export health rules from')
+    apps.add_argument('--apps', help='comma separated list of Appd apps to export health rules from')
+    apps.add_argument('--all_apps', help='export the health rules of all apps on the controller',
+                      action='store_true', default=False)
+    parser.add_argument('--output_dir', help='directory for the per-app xml files and index', default='.')
+    parser.add_argument('--archive', help='write a single zip archive with the per-app xml files and index instead',
+                        default=None)
+    parser.add_argument('--max_workers', help='max number of apps exported concurrently', type=int,
+                        default=EXPORT_MAX_WORKERS)
     args = parser.parse_args()
     print('args: ' + str(args))
     return args
 
-def write_hrs(args):
-    url = get_controller_url(args.controller_host, args.controller_port, args.controller_ssl) + '/controller/healthrules/' + args.app
-    print('url: ' + url)
-    response = requests.get(url, auth=(args.user_name + '@' + args.account_name, args.user_pass))
-    response.raise_for_status();
-    print('response: ' + str(response))
-    
-    xml_file = args.app + '-healthrules' + '.xml'
-    xml_string = xml.dom.minidom.parseString(str(response.content.decode("utf-8")))
-    pretty_xml_string = xml_string.toprettyxml()
-    with open(xml_file, 'w', encoding='utf-8') as file:    
-        file.write(pretty_xml_string)
-    print('wrote hrs to: ' + xml_file)
+def get_client(args):
+    sys.path.insert(0, REPO_DIR)
+    from controller_client import ControllerClient
+    return ControllerClient(get_controller_url(args.controller_host, args.controller_port, args.controller_ssl),
+                            args.user_name + '@' + args.account_name, args.user_pass, pool_maxsize=args.max_workers)
+
+def get_all_apps(client):
+    response = client.get('/controller/rest/applications', params={'output': 'json'})
+    response.raise_for_status()
+    return [app['name'] for app in response.json()]
+
+def get_apps(args, client):
+    if args.all_apps:
+        return get_all_apps(client)
+    if args.apps:
+        return [app.strip() for app in args.apps.split(',') if app.strip()]
+    return [args.app]
+
+def get_xml_file_name(app):
+    return re.sub(r'[^\w.-]+', '_', app) + '-healthrules.xml'
+
+def indent(element, level):
+    """pretty prints an element in place, like the controller's own exports"""
+    children = list(element)
+    if not children:
+        return
+    if not element.text or not element.text.strip():
+        element.text = '\n' + INDENT * (level + 1)
+    for child in children:
+        indent(child, level + 1)
+        if not child.tail or not child.tail.strip():
+            child.tail = '\n' + INDENT * (level + 1)
+    children[-1].tail = '\n' + INDENT * level
+
+def write_hrs(client, app, xml_file):
+    """streams the app's health rule export into xml_file one <health-rule> at a time; returns the rule names"""
+    response = client.get('/controller/healthrules/' + app, stream=True)
+    try:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return write_healthrules_xml(response.raw, xml_file)
+    finally:
+        response.close()
+
+def write_healthrules_xml(source, xml_file):
+    names = []
+    with open(xml_file, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        root = None
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if root is None:
+                root = element
+                attributes = ''.join(' ' + name + '=' + quoteattr(value) for name, value in element.attrib.items())
+                file.write('<' + element.tag + attributes + '>\n')
+            elif event == 'end' and element.tag == 'health-rule' and element in root:
+                names.append(element.findtext('name'))
+                indent(element, 1)
+                element.tail = None
+                file.write(INDENT + ElementTree.tostring(element, encoding='unicode') + '\n')
+                root.remove(element)
+        if root is not None:
+            file.write('</' + root.tag + '>\n')
+    return names
+
+def export_app(client, app, output_dir):
+    xml_file = get_xml_file_name(app)
+    try:
+        names = write_hrs(client, app, os.path.join(output_dir, xml_file))
+    except Exception as e:
+        return {'app': app, 'error': str(e)}
+    return {'app': app, 'file': xml_file, 'health_rule_count': len(names), 'health_rules': names}
+
+def export_apps(client, apps, output_dir, max_workers, on_exported=None):
+    """exports the apps concurrently; on_exported is called in this thread with the index entry of each app"""
+    index = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(export_app, client, app, output_dir) for app in apps]
+        for future in as_completed(futures):
+            entry = future.result()
+            if 'error' in entry:
+                print('failed to export hrs of app ' + entry['app'] + ': ' + entry['error'])
+            else:
+                print('wrote ' + str(entry['health_rule_count']) + ' hrs of app ' + entry['app'] + ' to: ' +
+                      entry['file'])
+            if on_exported is not None:
+                on_exported(entry)
+            index.append(entry)
+    index.sort(key=lambda entry: entry['app'])
+    return index
+
+def write_index(index, index_file):
+    with open(index_file, 'w', encoding='utf-8') as file:
+        json.dump({'apps': index}, file, indent=2)
+
+def export_to_dir(client, apps, output_dir, max_workers):
+    os.makedirs(output_dir, exist_ok=True)
+    index = export_apps(client, apps, output_dir, max_workers)
+    write_index(index, os.path.join(output_dir, INDEX_FILE))
+    print('wrote index to: ' + os.path.join(output_dir, INDEX_FILE))
+    return index
+
+def export_to_archive(client, apps, archive_file, max_workers):
+    """apps are exported to a temporary directory and moved into the archive as each one completes"""
+    work_dir = tempfile.mkdtemp()
+    try:
+        with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+            def add_to_archive(entry):
+                if 'file' in entry:
+                    xml_file = os.path.join(work_dir, entry['file'])
+                    archive.write(xml_file, entry['file'])
+                    os.remove(xml_file)
+            index = export_apps(client, apps, work_dir, max_workers, add_to_archive)
+            archive.writestr(INDEX_FILE, json.dumps({'apps': index}, indent=2))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print('wrote archive to: ' + archive_file)
+    return index
 
 
 def run():
     args = parse_args()
-    write_hrs(args)
-    
+    client = get_client(args)
+    apps = get_apps(args, client)
+    print('exporting hrs of ' + str(len(apps)) + ' apps')
+    if args.archive:
+        index = export_to_archive(client, apps, args.archive, args.max_workers)
+    else:
+        index = export_to_dir(client, apps, args.output_dir, args.max_workers)
+    failed = [entry['app'] for entry in index if 'error' in entry]
+    if failed:
+        print('failed to export hrs of apps: ' + ', '.join(failed))
+        sys.exit(1)
+
 if __name__ == '__main__':
     run()
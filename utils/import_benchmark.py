@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""measures how long importing pcf_dash_generator and building its flask app take in a fresh interpreter, optionally
+compared with another git revision of the repo"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['flask', 'werkzeug', 'jinja2', 'requests', 'urllib3', 'tenacity']
+# runs in the child interpreter; older revisions build the app at import and expose it as pcf_dash_generator.service
+MEASURE_CODE = '''
+import sys, time, json
+start = time.perf_counter()
+import pcf_dash_generator
+imported = time.perf_counter()
+heavy_modules = [name for name in %r if name in sys.modules]
+modules = len(sys.modules)
+if hasattr(pcf_dash_generator, 'create_app'):
+    pcf_dash_generator.create_app()
+ready = time.perf_counter()
+print(json.dumps({'import_seconds': imported - start, 'app_ready_seconds': ready - start,
+                  'modules_after_import': modules, 'heavy_modules_after_import': heavy_modules}))
+''' % HEAVY_MODULES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', help='number of fresh interpreters to measure', type=int, default=10)
+    parser.add_argument('--baseline_rev', help='git revision to compare with, e.g. HEAD~1', default=None)
+    parser.add_argument('--json', help='print results as json', action='store_true', default=False)
+    args = parser.parse_args()
+    return args
+
+
+def get_env(source_dir):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': source_dir,
+        'PYTHONDONTWRITEBYTECODE': '1',
+        'APPD_MA_HOST_NAME': '127.0.0.1',
+        'APPD_MA_PORT': '8090',
+        'APPD_MA_USER_NAME': 'benchmark',
+        'APPD_MA_USER_PASS': 'benchmark',
+        'APPD_NOZZLE_APP_NAME': 'PCF',
+        'APPD_NOZZLE_TIER_NAME': 'foundation-01',
+        'APPD_NOZZLE_TIER_ID': '118'
+    })
+    return env
+
+
+def measure(source_dir, runs):
+    samples = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE_CODE], cwd=source_dir, env=get_env(source_dir),
+                                         stderr=subprocess.DEVNULL)
+        samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    return {
+        'import_seconds': round(statistics.median(sample['import_seconds'] for sample in samples), 4),
+        'app_ready_seconds': round(statistics.median(sample['app_ready_seconds'] for sample in samples), 4),
+        'modules_after_import': samples[-1]['modules_after_import'],
+        'heavy_modules_after_import': samples[-1]['heavy_modules_after_import']
+    }
+
+
+def export_revision(rev, target_dir):
+    archive = subprocess.Popen(['git', 'archive', rev], cwd=REPO_DIR, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', target_dir], stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise RuntimeError('git archive failed for revision: ' + rev)
+
+
+def print_result(label, result):
+    print('%-12s import=%7.4fs app ready=%7.4fs modules after import=%4d heavy modules after import: %s' %
+          (label, result['import_seconds'], result['app_ready_seconds'], result['modules_after_import'],
+           ', '.join(result['heavy_modules_after_import']) or 'none'))
+
+
+def run():
+    args = parse_args()
+    results = {'current': measure(REPO_DIR, args.runs)}
+    if args.baseline_rev:
+        with tempfile.TemporaryDirectory() as baseline_dir:
+            export_revision(args.baseline_rev, baseline_dir)
+            results[args.baseline_rev] = measure(baseline_dir, args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for label, result in results.items():
+        print_result(label, result)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""renders the dashboards and health rules of many discovery snapshots (see --snapshot_dir of pcf_dash_generator.py)
+in parallel worker processes, without accessing any controller, e.g. to pre-stage foundations, to check template changes
+against every recorded foundation or to roll out a template upgrade"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('snapshots', help='snapshot files, or directories with snapshot files', nargs='+')
+    parser.add_argument('--output_dir', help='directory to write the generated files to', default='generated')
+    parser.add_argument('--max_workers', help='number of worker processes, defaults to the cpu count', type=int,
+                        default=None)
+    args = parser.parse_args()
+    print('args: ' + str(args))
+    return args
+
+
+def get_snapshot_files(snapshots, snapshot_suffix):
+    snapshot_files = []
+    for snapshot in snapshots:
+        if os.path.isdir(snapshot):
+            snapshot_files.extend(os.path.join(snapshot, file_name) for file_name in sorted(os.listdir(snapshot))
+                                  if file_name.endswith(snapshot_suffix))
+        else:
+            snapshot_files.append(snapshot)
+    return snapshot_files
+
+
+def render_snapshots(snapshot_files, output_dir, max_workers=None):
+    """returns a dict of snapshot file to its generated files, or to the exception raised while rendering it"""
+    import pcf_dash_generator
+    from template_registry import template_registry
+    os.makedirs(output_dir, exist_ok=True)
+    # compiled once here, so that forked workers share the compiled templates instead of each compiling them
+    template_registry.get(pcf_dash_generator.pcf_dash_template_file)
+    template_registry.get(pcf_dash_generator.pcf_hrs_template_file)
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(pcf_dash_generator.render_snapshot, snapshot_file, output_dir): snapshot_file
+                   for snapshot_file in snapshot_files}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print('failed to render snapshot ' + futures[future] + ': ' + repr(e))
+                results[futures[future]] = e
+    return results
+
+
+def run():
+    args = parse_args()
+    output_dir = os.path.abspath(args.output_dir)
+    snapshots = [os.path.abspath(snapshot) for snapshot in args.snapshots]
+    # the templates are read relative to the repo, like the service does from its app directory
+    os.chdir(REPO_DIR)
+    sys.path.insert(0, REPO_DIR)
+    from pcf_dash_generator import SNAPSHOT_SUFFIX
+    snapshot_files = get_snapshot_files(snapshots, SNAPSHOT_SUFFIX)
+    start = time.time()
+    results = render_snapshots(snapshot_files, output_dir, args.max_workers)
+    failed = [snapshot_file for snapshot_file, result in results.items() if isinstance(result, Exception)]
+    print('rendered ' + str(len(results) - len(failed)) + ' of ' + str(len(results)) + ' snapshots to ' + output_dir +
+          ' in ' + str(round(time.time() - start, 2)) + 's')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
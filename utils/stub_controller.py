@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""local stand-in for the AppD controller endpoints used by pcf_dash_generator, for benchmarks and local testing"""
+import io
+import re
+import sys
+import zlib
+import json
+import hashlib
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from flask import Flask, request, Response, make_response
+
+PCF_SERVICE_NAMES = ['clock_global', 'cloud_controller', 'cloud_controller_worker', 'consul_server', 'credhub',
+                     'diego_brain', 'diego_cell', 'diego_database', 'doppler', 'loggregator_trafficcontroller',
+                     'mysql', 'mysql_proxy', 'nats', 'router', 'syslog_adapter', 'syslog_scheduler', 'tcp_router', 'uaa']
+SYSTEM_METRICS_FORWARDER = 'bosh-system-metrics-forwarder'
+PARENT_FOLDER = 'cf-b9d6aaa85e4cb19f2c92'
+# an additional cf-* folder without diego_cell metrics, as seen on foundations after a redeploy
+STALE_PARENT_FOLDER = 'cf-0123456789abcdef0123'
+CSRF_TOKEN = 'stub-csrf-token'
+
+
+class StubController(object):
+
+    def __init__(self, diego_cells=3, instances=1, latency=0.0, hr_save_delay=0.0, accept_gzip=True):
+        self.diego_cells = diego_cells
+        self.accept_gzip = accept_gzip
+        self.instances = instances
+        self.latency = latency
+        self.hr_save_delay = hr_save_delay
+        self.lock = threading.Lock()
+        self.healthrules = {}
+        self.dashboards = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'requests_by_endpoint': {}, 'bytes_received': 0, 'bytes_uploaded': 0,
+                          'bytes_sent': 0}
+
+    def record(self, endpoint, bytes_received, bytes_sent, upload=False):
+        with self.lock:
+            self.stats['requests'] += 1
+            by_endpoint = self.stats['requests_by_endpoint']
+            by_endpoint[endpoint] = by_endpoint.get(endpoint, 0) + 1
+            self.stats['bytes_received'] += bytes_received
+            self.stats['bytes_sent'] += bytes_sent
+            if upload:
+                self.stats['bytes_uploaded'] += bytes_received
+
+    def get_instance_count(self, service_name):
+        return self.diego_cells if service_name == 'diego_cell' else self.instances
+
+    def list_metric_path(self, metric_path):
+        segments = metric_path.split('|')
+        if SYSTEM_METRICS_FORWARDER not in segments:
+            return []
+        rest = segments[segments.index(SYSTEM_METRICS_FORWARDER) + 1:]
+        if len(rest) == 0:
+            return [STALE_PARENT_FOLDER, PARENT_FOLDER]
+        if rest[0] != PARENT_FOLDER:
+            return []
+        if len(rest) == 1:
+            return PCF_SERVICE_NAMES
+        if len(rest) == 2 and rest[1] in PCF_SERVICE_NAMES:
+            return ['%08d-0000-4000-8000-%012d' % (PCF_SERVICE_NAMES.index(rest[1]), i)
+                    for i in range(self.get_instance_count(rest[1]))]
+        return []
+
+    def save_healthrules(self, app, healthrules_xml, overwrite):
+        visible_at = time.time() + self.hr_save_delay
+        with self.lock:
+            saved = self.healthrules.setdefault(app, OrderedDict())
+            for healthrule in re.findall('<health-rule>.*?</health-rule>', healthrules_xml, re.S):
+                name = re.search('<name>(.*?)</name>', healthrule, re.S).group(1)
+                if overwrite or name not in saved:
+                    saved[name] = (healthrule, visible_at)
+
+    def export_healthrules(self, app):
+        now = time.time()
+        with self.lock:
+            saved = self.healthrules.get(app, {})
+            healthrules = [healthrule for healthrule, visible_at in saved.values() if visible_at <= now]
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<health-rules controller-version="004-004-003-004">' +\
+               ''.join(healthrules) + '</health-rules>'
+
+
+class GzipRequestMiddleware(object):
+    """decompresses gzip encoded request bodies, keeping the size on the wire for the stats"""
+
+    def __init__(self, app, stub):
+        self.app = app
+        self.stub = stub
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            if not self.stub.accept_gzip:
+                start_response('415 Unsupported Media Type', [('Content-Type', 'text/plain')])
+                return [b'gzip encoded requests are not supported']
+            body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+            environ['stub.wire_content_length'] = len(body)
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
+
+
+def create_stub_app(stub):
+    app = Flask(__name__)
+    app.wsgi_app = GzipRequestMiddleware(app.wsgi_app, stub)
+
+    @app.before_request
+    def simulate_latency():
+        if stub.latency:
+            time.sleep(stub.latency)
+
+    def respond(endpoint, body, status=200, upload=False, content_type='application/json'):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        stub.record(endpoint, request.environ.get('stub.wire_content_length', request.content_length or 0), len(body),
+                    upload)
+        return Response(body, status, content_type=content_type)
+
+    @app.route('/controller/auth')
+    def login():
+        stub.record('login', 0, 0)
+        response = make_response('')
+        response.set_cookie('X-CSRF-TOKEN', CSRF_TOKEN)
+        response.set_cookie('JSESSIONID', 'stub-session')
+        return response
+
+    @app.route('/controller/rest/applications')
+    def applications():
+        with stub.lock:
+            app_names = sorted(stub.healthrules)
+        return respond('applications', json.dumps([{'name': app_name, 'id': i + 1}
+                                                   for i, app_name in enumerate(app_names)]))
+
+    @app.route('/controller/rest/applications/<app_name>/metrics')
+    def metrics(app_name):
+        folders = stub.list_metric_path(request.args.get('metric-path', ''))
+        return respond('metrics', json.dumps([{'name': folder, 'type': 'folder'} for folder in folders]))
+
+    @app.route('/controller/healthrules/<app_name>', methods=['GET', 'POST'])
+    def healthrules(app_name):
+        if request.method == 'POST':
+            uploaded = request.files['file'].read().decode('utf-8')
+            stub.save_healthrules(app_name, uploaded, request.args.get('overwrite') == 'true')
+            return respond('healthrules_upload', 'ok', upload=True, content_type='text/plain')
+        return respond('healthrules_export', stub.export_healthrules(app_name), content_type='application/xml')
+
+    @app.route('/controller/restui/dashboards/getAllDashboardsByType/false')
+    def dashboards():
+        if request.headers.get('X-CSRF-TOKEN') != CSRF_TOKEN:
+            return respond('dashboards', 'missing csrf token', 401, content_type='text/plain')
+        with stub.lock:
+            listing = [{'id': dashboard_id, 'name': name} for name, dashboard_id in stub.dashboards.items()]
+        body = json.dumps(listing)
+        etag = '"' + hashlib.sha1(body.encode('utf-8')).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            response = respond('dashboards', '', 304)
+        else:
+            response = respond('dashboards', body)
+        response.headers['ETag'] = etag
+        return response
+
+    @app.route('/controller/CustomDashboardImportExportServlet', methods=['POST'])
+    def import_dashboard():
+        dashboard = json.loads(request.files['file'].read().decode('utf-8'))
+        with stub.lock:
+            dashboard_id = stub.dashboards.setdefault(dashboard['name'], len(stub.dashboards) + 1)
+        return respond('dashboard_upload', json.dumps({'success': True, 'errors': [],
+                                                       'dashboard': {'id': dashboard_id, 'name': dashboard['name']}}),
+                       upload=True)
+
+    @app.route('/stub/stats', methods=['GET', 'DELETE'])
+    def stats():
+        if request.method == 'DELETE':
+            stub.reset_stats()
+        with stub.lock:
+            return Response(json.dumps(stub.stats), content_type='application/json')
+
+    return app
+
+
+def serve(port, diego_cells=3, instances=1, latency=0.0, hr_save_delay=0.0, ready=None, quiet=False, accept_gzip=True):
+    from werkzeug.serving import make_server
+    if quiet:
+        import logging
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    stub = StubController(diego_cells, instances, latency, hr_save_delay, accept_gzip)
+    server = make_server('127.0.0.1', port, create_stub_app(stub), threaded=True)
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', help='the port to listen on', type=int, default=8090)
+    parser.add_argument('--diego_cells', help='number of diego_cell instances', type=int, default=3)
+    parser.add_argument('--instances', help='number of instances of every other pcf service', type=int, default=1)
+    parser.add_argument('--latency_ms', help='latency added to every request', type=float, default=0)
+    parser.add_argument('--hr_save_delay', help='seconds before uploaded health rules show up in the export',
+                        type=float, default=0)
+    parser.add_argument('--reject_gzip', help='reject gzip encoded uploads with 415', action='store_true', default=False)
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def run():
+    args = parse_args()
+    print('stub controller listening on http://127.0.0.1:' + str(args.port), file=sys.stderr)
+    serve(args.port, args.diego_cells, args.instances, args.latency_ms / 1000.0, args.hr_save_delay,
+          accept_gzip=not args.reject_gzip)
+
+
+if __name__ == '__main__':
+    run()